@@ -0,0 +1,209 @@
+"""Benchmarks of numset, run with "python bench_numset.py --help"."""
+
+
+import argparse
+import json
+import platform
+import sys
+import timeit
+
+import numpy
+
+import numset
+from numset import Set, Domain
+
+
+# Each benchmark receives the size and the dtype of the domain and returns
+# the function to time. The setup work is done before returning it.
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    def register(function):
+        BENCHMARKS[name] = function
+        return function
+    return register
+
+
+def _data(size, dtype):
+    return numpy.arange(size, dtype=dtype)
+
+
+def _set(size, dtype, offset=0):
+    data = _data(size, dtype) + offset
+    s = Set(x for x in data if x % 2 == 0)
+    len(s)
+    return s
+
+
+@benchmark("construction")
+def construction(size, dtype):
+    data = _data(size, dtype)
+    return lambda: Set(x*2 for x in data if x > 0)
+
+
+@benchmark("construction_cold")
+def construction_cold(size, dtype):
+    data = _data(size, dtype)
+
+    def run():
+        numset.code_cache.clear()
+        return Set(x*2 for x in data if x > 0)
+    return run
+
+
+@benchmark("materialize_vectorized")
+def materialize_vectorized(size, dtype):
+    data = _data(size, dtype)
+    return lambda: len(Set(x*2 for x in data if x % 3 == 0))
+
+
+@benchmark("materialize_python")
+def materialize_python(size, dtype):
+    data = _data(size, dtype)
+    return lambda: len(Set((x*2 for x in data if x % 3 == 0),
+                            vectorize=False))
+
+
+def _operator(name):
+    def setup(size, dtype):
+        a = _set(size, dtype)
+        b = _set(size, dtype, size // 2)
+
+        def run():
+            result = getattr(a, name)(b)
+            if isinstance(result, numset.BaseSet):
+                iter(result)
+            return result
+        return run
+    return setup
+
+
+for _name in ("union", "intersection", "difference", "symmetric_difference",
+              "issubset", "isdisjoint", "__eq__"):
+    benchmark("operator_" + _name.strip("_"))(_operator(_name))
+
+
+@benchmark("product")
+def product(size, dtype):
+    a, b = _set(size, dtype), _set(size, dtype, 1)
+    return lambda: len(Set((x, y) for x, y in a*b))
+
+
+@benchmark("power")
+def power(size, dtype):
+    a = _set(size, dtype)
+    return lambda: a**2
+
+
+@benchmark("sum")
+def sum_(size, dtype):
+    a, b = _set(size, dtype), _set(size, dtype, size)
+    return lambda: list(a + b)
+
+
+@benchmark("contains")
+def contains(size, dtype):
+    a = _set(size, dtype)
+    values = _data(size, dtype)[::max(1, size // 100)].tolist()
+    return lambda: [v in a for v in values]
+
+
+@benchmark("isin")
+def isin(size, dtype):
+    a = _set(size, dtype)
+    values = _data(2*size, dtype)
+    return lambda: a.isin(values)
+
+
+@benchmark("call")
+def call(size, dtype):
+    a = _set(size, dtype)
+    values = _data(size, dtype)[:100].tolist()
+    return lambda: [a(v) for v in values]
+
+
+@benchmark("call_memoized")
+def call_memoized(size, dtype):
+    data = _data(size, dtype)
+    a = Set((x for x in data if x % 2 == 0), memoize=128)
+    values = data[:100].tolist()
+    return lambda: [a(v) for v in values]
+
+
+@benchmark("domain")
+def domain(size, dtype):
+    data = _data(size, dtype).tolist()
+    return lambda: Domain(data)
+
+
+# Time a function with the best and the mean of the repetitions, in seconds
+# by call. The amount of calls by repetition is chosen by timeit.
+def measure(function, repeat):
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    times = [t / number for t in timer.repeat(repeat, number)]
+    return {"best": min(times), "mean": sum(times) / len(times),
+            "number": number, "repeat": repeat}
+
+
+def run(names, sizes, dtypes, repeat):
+    results = []
+    for name in names:
+        for size in sizes:
+            for dtype in dtypes:
+                function = BENCHMARKS[name](size, dtype)
+                result = {"name": name, "size": size, "dtype": dtype}
+                result.update(measure(function, repeat))
+                results.append(result)
+                print("%-32s %9d %-8s %12.3e s" % (name, size, dtype,
+                                                   result["best"]),
+                      file=sys.stderr)
+    return results
+
+
+def environment():
+    return {"python": platform.python_version(),
+            "numpy": numpy.__version__,
+            "machine": platform.machine(),
+            "system": platform.system()}
+
+
+# Print the ratio between the best times of two runs for each benchmark
+def compare(baseline, results):
+    key = lambda r: (r["name"], r["size"], r["dtype"])
+    old = {key(r): r["best"] for r in baseline["results"]}
+    for r in results:
+        if key(r) in old:
+            print("%-32s %9d %-8s %8.2fx" % (*key(r),
+                                              r["best"] / old[key(r)]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("names", nargs="*", default=sorted(BENCHMARKS),
+                        help="benchmarks to run, all by default")
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[1000, 100000])
+    parser.add_argument("--dtypes", nargs="+", default=["int64", "float64"])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="save the results in a JSON file")
+    parser.add_argument("--compare", help="JSON file of a previous run")
+    args = parser.parse_args(argv)
+    unknown = set(args.names) - set(BENCHMARKS)
+    if unknown:
+        parser.error("unknown benchmarks: %s" % ", ".join(sorted(unknown)))
+    results = run(args.names, args.sizes, args.dtypes, args.repeat)
+    report = {"environment": environment(), "results": results}
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+    if args.compare:
+        with open(args.compare) as file:
+            compare(json.load(file), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -11,273 +11,1700 @@
 
 
 from collections import abc
+import ast
+import builtins
+import collections
+import concurrent.futures
+import copy
+import dis
+import fractions
 import functools
+import gc
+import importlib
 import itertools
-import opcode
+import json
+import linecache
+import marshal
+import math
+import operator
+import os
+import sys
+import tempfile
+import threading
+import time
 import types
+import weakref
 
-import bytecode
 import numpy
-
-
-# In the generator, jump to loop start label if the element satisfy the
-# constraint. The loop start label in the generator will be the function end
-# label.
-def _get_new_end_label(old_bytecode):
-    for i in old_bytecode:
-        if isinstance(i, bytecode.Label):
-            return i  # First label found will be the function end label
-
-
-# Find the generator end label
-def _get_old_end_label(old_bytecode):
-    for i in reversed(old_bytecode):
-        if isinstance(i, bytecode.Label):
-            return i  # Penultimate label found is that will be replaced
-
-
-# Find the start of the new bytecode. The
-# beginign is before the loop initialization.
-def _get_new_start(old_bytecode):
-    sentinel = 0
-    for i, b in enumerate(old_bytecode):
-
-        # Come here if the FOR_ITER bytecode is stil not found
-        if sentinel == 0:
-
-            # I know that I enter to the loop set
-            # up when I found the FOR_ITER bytecode
-            if isinstance(b, bytecode.Instr) and b.name == "FOR_ITER":
-                sentinel = 1  # report that FOR_ITER was already found
-
-        # Come here if the FOR_ITER bytecode was found
-        elif sentinel == 1:
-            if b.name == "UNPACK_SEQUENCE":
-                continue
-            previous_name = b.name
-            sentinel = 2
-
-        # I know that the loop set up was finished when
-        # the current bytecode is different of the previous
-        elif isinstance(b, bytecode.Instr) and b.name != previous_name:
-            return i
-
-
-# Get the member part of the generator expression. See NOTE 1
-def _get_member_bytecode(generator):
-    old_bytecode = bytecode.Bytecode.from_code(generator.gi_code)
-    new_bytecode = bytecode.Bytecode()
-
-    # Member bytecode start after the last POP_JUMP_IF_FALSE bytecode
-    start_list = []
-    for ns, b in enumerate(old_bytecode):
-        if isinstance(b, bytecode.Instr) and b.name == "POP_JUMP_IF_FALSE":
-            start_list.append(ns)
-    if start_list:
-        new_start = start_list.pop()
+import sympy
+
+
+class CacheInfo(collections.namedtuple("CacheInfo",
+                                       "hits misses maxsize currsize")):
+    __slots__ = ()
+
+    @property
+    def hit_rate(self):
+        calls = self.hits + self.misses
+        return self.hits / calls if calls else 0.0
+
+
+class CodeCache:
+    """A bounded LRU cache of the code objects derived from a generator.
+
+    The entries are keyed by the generator code object, so every generator
+    made by the same generator expression share the member, constraint and
+    function code. Only the globals are rebound in each call.
+    """
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, generator, part, build):
+        """Return the code of the given part. Call build on a miss."""
+        key = generator.gi_code
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and part in entry:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[part]
+            self.misses += 1
+        code = build(generator)
+        with self._lock:
+            self._entries.setdefault(key, {})[part] = code
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return code
+
+    def info(self):
+        """Report the cache statistics."""
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize,
+                             len(self._entries))
+
+    def clear(self):
+        """Remove all entries and reset the statistics."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+code_cache = CodeCache()
+
+
+class CallCache:
+    """A bounded LRU cache of the results of a function by arguments.
+
+    The calls with unhashable arguments and the calls that raise are not
+    cached.
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+
+    def call(self, function, args):
+        """Return function(*args), from the cache if it is possible."""
+        try:
+            hash(args)
+        except TypeError:
+            return function(*args)
+        with self._lock:
+            if args in self._entries:
+                self._entries.move_to_end(args)
+                self.hits += 1
+                return self._entries[args]
+            self.misses += 1
+            generation = self._generation
+        result = function(*args)
+        with self._lock:
+            if generation != self._generation:
+                return result  # cleared while it was computed
+            self._entries[args] = result
+            self._entries.move_to_end(args)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return result
+
+    def info(self):
+        """Report the cache statistics."""
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize,
+                             len(self._entries))
+
+    def clear(self):
+        """Remove all entries and reset the statistics."""
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+            self.hits = 0
+            self.misses = 0
+
+
+# NOTE 3: The engines do not call the member and the constraint functions to
+# analyse them. They use an expression tree (see _Node) that the front end
+# builds with the source of the generator expression (see NOTE 2). The
+# vectorized engine evaluates it with whole NumPy arrays as variables. Each
+# operand of an "and" in the constraint is a conjunct, so "x > 0 and x < 5"
+# is evaluated as "(x > 0) & (x < 5)". A chained comparison is split in the
+# same way.
+#
+#      x % 2 == 0 and x > 2  ──>  conjuncts: (compare ==, (binary %, x, 2), 0)
+#                                 value:     (compare >, x, 2)
+
+
+_Node = collections.namedtuple("_Node", "op args")
+_Trace = collections.namedtuple("_Trace", "conjuncts value")
+
+
+class _Unsupported(Exception):
+    """The code can not be handled by the vectorized engine."""
+
+
+_BINARY_OPERATORS = {
+    "+": operator.add, "-": operator.sub, "*": operator.mul,
+    "/": operator.truediv, "//": operator.floordiv, "%": operator.mod,
+    "**": operator.pow, "@": operator.matmul, "&": operator.and_,
+    "|": operator.or_, "^": operator.xor, "<<": operator.lshift,
+    ">>": operator.rshift}
+
+_UNARY_OPERATORS = {"-": operator.neg, "+": operator.pos,
+                    "~": operator.invert, "not": numpy.logical_not}
+
+_COMPARE_OPERATORS = {"<": operator.lt, "<=": operator.le, "==": operator.eq,
+                      "!=": operator.ne, ">": operator.gt, ">=": operator.ge}
+
+# Symbols of the operator nodes of the ast module
+_AST_SYMBOLS = {
+    ast.Add: "+", ast.Sub: "-", ast.Mult: "*", ast.Div: "/",
+    ast.FloorDiv: "//", ast.Mod: "%", ast.Pow: "**", ast.MatMult: "@",
+    ast.BitAnd: "&", ast.BitOr: "|", ast.BitXor: "^", ast.LShift: "<<",
+    ast.RShift: ">>", ast.USub: "-", ast.UAdd: "+", ast.Invert: "~",
+    ast.Not: "not", ast.Lt: "<", ast.LtE: "<=", ast.Eq: "==",
+    ast.NotEq: "!=", ast.Gt: ">", ast.GtE: ">="}
+
+# Builtin functions that have an element-wise NumPy equivalent
+_VECTORIZED_BUILTINS = {abs: numpy.absolute}
+
+
+def _symbol(op):
+    try:
+        return _AST_SYMBOLS[type(op)]
+    except KeyError:
+        raise _Unsupported("Unknown operator %s." % type(op).__name__)
+
+
+# Replace an arithmetic node of number constants by its value, as python
+# does with "-1" or "10/3". The big powers and shifts are not folded.
+def _fold(node):
+    symbol, *operands = node.args
+    if symbol not in ("+", "-", "*", "/", "//", "%", "**", "<<") \
+            or any(o.op != "const" or type(o.args[0]) not in (int, float)
+                   for o in operands):
+        return node
+    values = [o.args[0] for o in operands]
+    if symbol in ("**", "<<") and abs(values[1]) > 64:
+        return node
+    try:
+        if node.op == "unary":
+            return _Node("const", (_UNARY_OPERATORS[symbol](*values),))
+        return _Node("const", (_BINARY_OPERATORS[symbol](*values),))
+    except (ArithmeticError, ValueError):
+        return node
+
+
+# Build the expression tree of an AST expression. The names that are not
+# variables nor free variables are globals.
+def _tree(node, varnames, freevars):
+    if isinstance(node, ast.Name):
+        if node.id in varnames:
+            return _Node("var", (varnames.index(node.id),))
+        if node.id in freevars:
+            return _Node("free", (node.id,))
+        return _Node("global", (node.id,))
+    elif isinstance(node, ast.Constant):
+        return _Node("const", (node.value,))
+    elif isinstance(node, ast.Attribute):
+        return _Node("attr", (_tree(node.value, varnames, freevars),
+                              node.attr))
+    elif isinstance(node, ast.Call):
+        if node.keywords or any(isinstance(a, ast.Starred)
+                                for a in node.args):
+            raise _Unsupported("Only positional arguments are supported.")
+        return _Node("call", tuple(_tree(a, varnames, freevars)
+                                   for a in [node.func] + node.args))
+    elif isinstance(node, ast.BinOp):
+        return _fold(_Node("binary", (_symbol(node.op),
+                                      _tree(node.left, varnames, freevars),
+                                      _tree(node.right, varnames, freevars))))
+    elif isinstance(node, ast.UnaryOp):
+        return _fold(_Node("unary", (_symbol(node.op),
+                                     _tree(node.operand, varnames,
+                                           freevars))))
+    elif isinstance(node, ast.Compare) and len(node.ops) == 1:
+        return _Node("compare", (_symbol(node.ops[0]),
+                                 _tree(node.left, varnames, freevars),
+                                 _tree(node.comparators[0], varnames,
+                                       freevars)))
+    elif isinstance(node, ast.Tuple):
+        return _Node("tuple", tuple(_tree(e, varnames, freevars)
+                                    for e in node.elts))
+    raise _Unsupported("Unsupported expression %s." % type(node).__name__)
+
+
+# Split a condition in the trees of its conjuncts. The operands of a chained
+# comparison share the same tree, so they are evaluated once.
+def _conjuncts(node, varnames, freevars):
+    if isinstance(node, ast.BoolOp) and isinstance(node.op, ast.And):
+        return [c for v in node.values
+                for c in _conjuncts(v, varnames, freevars)]
+    if isinstance(node, ast.Compare) and len(node.ops) > 1:
+        operands = [_tree(o, varnames, freevars)
+                    for o in [node.left] + node.comparators]
+        return [_Node("compare", (_symbol(op), left, right))
+                for op, left, right in zip(node.ops, operands, operands[1:])]
+    return [_tree(node, varnames, freevars)]
+
+
+# Return the traces of the member and of the constraint. Each one is None if
+# it can not be vectorized.
+def _expression_traces(node, varnames, freevars):
+    try:
+        member = _Trace((), _tree(node.elt, varnames, freevars))
+    except _Unsupported:
+        member = None
+    try:
+        conjuncts = [c for i in node.generators[0].ifs
+                     for c in _conjuncts(i, varnames, freevars)]
+        conjuncts = conjuncts or [_Node("const", (True,))]
+        constraint = _Trace(tuple(conjuncts[:-1]), conjuncts[-1])
+    except _Unsupported:
+        constraint = None
+    return member, constraint
+
+
+# NOTE 2: The front end finds the GeneratorExp node of a generator in the
+# source file of its code. The node starts in the first line of the code, its
+# "for" target has the variables of the code, its span covers the positions
+# of the instructions of the code (the smallest one, if they are nested) and
+# the source compiles to the same code in that line, so a source file that
+# changed after the import is not used. It is parsed once by code object
+# (see CodeCache) in an _Expression: the variables, that are the arguments of
+# the new functions, and the code of the member, the constraint and the
+# function, that are compiled with the nodes of the expression. The
+# expression trees of that codes are kept in _TRACES, so every engine gets
+# them without analyse the code again. The functions share the cells of the
+# free variables with the generator. The free variables are "free" nodes in
+# the trees, that _trace replaces by constants with the values of the cells
+# of the function when an engine takes the trees.
+#
+# Without the source (the REPL, "python -c", exec or only .pyc files) the
+# functions run the code of the generator over a single element. They have
+# not expression trees, so the sets are computed element by element.
+
+
+_Expression = collections.namedtuple(
+    "_Expression", "varnames member constraint function")
+
+# The expression trees of the code made by the front end. See NOTE 3
+_TRACES = weakref.WeakKeyDictionary()
+
+# The free variable of the functions made without source that has the
+# function of the generator
+_GENERATOR = "__generator"
+
+
+# The GeneratorExp nodes of a source file by line
+@functools.lru_cache(maxsize=32)
+def _source_nodes(source, filename):
+    nodes = collections.defaultdict(list)
+    for node in ast.walk(ast.parse(source, filename)):
+        if isinstance(node, ast.GeneratorExp):
+            nodes[node.lineno].append(node)
+    return nodes
+
+
+def _target_names(target):
+    if isinstance(target, ast.Name):
+        return (target.id,)
+    if isinstance(target, ast.Tuple) \
+            and all(isinstance(e, ast.Name) for e in target.elts):
+        return tuple(e.id for e in target.elts)
+    raise TypeError("The variables must be names or a tuple of names.")
+
+
+# Check if the span of the node contains the span of an instruction
+def _covers(node, position):
+    line, end_line, column, end_column = position
+    return (node.lineno, node.col_offset) <= (line, column) \
+        and (end_line, end_column) <= (node.end_lineno, node.end_col_offset)
+
+
+# Compare two code objects, with the code of their nested expressions
+def _same_code(a, b):
+    if (a.co_code, a.co_names, a.co_varnames, a.co_freevars) \
+            != (b.co_code, b.co_names, b.co_varnames, b.co_freevars) \
+            or len(a.co_consts) != len(b.co_consts):
+        return False
+    for x, y in zip(a.co_consts, b.co_consts):
+        if isinstance(x, types.CodeType) and isinstance(y, types.CodeType):
+            if not _same_code(x, y):
+                return False
+        elif type(x) is not type(y) or not (x == y or x != x and y != y):
+            return False
+    return True
+
+
+# The code objects of the generator expressions of a source file by line
+@functools.lru_cache(maxsize=32)
+def _source_generators(source, filename):
+    generators = collections.defaultdict(list)
+    pending = [compile(source, filename, "exec", dont_inherit=True)]
+    while pending:
+        code = pending.pop()
+        if code.co_name == "<genexpr>":
+            generators[code.co_firstlineno].append(code)
+        pending.extend(c for c in code.co_consts
+                       if isinstance(c, types.CodeType))
+    return generators
+
+
+# Find the GeneratorExp node of a generator code or return None if the
+# source is not available or it does not match the code. See NOTE 2
+def _generator_node(code):
+    linecache.checkcache(code.co_filename)
+    lines = linecache.getlines(code.co_filename)
+    if not lines:
+        return None
+    source = "".join(lines)
+    try:
+        nodes = _source_nodes(source, code.co_filename)
+        generators = _source_generators(source, code.co_filename)
+    except (SyntaxError, ValueError):
+        return None
+    if not any(_same_code(c, code)
+               for c in generators.get(code.co_firstlineno, ())):
+        return None  # the source changed
+    positions = [p for p in getattr(code, "co_positions", tuple)()
+                 if None not in p and (p[0], p[2]) < (p[1], p[3])]
+    varnames = code.co_varnames[1:]
+    candidates = []
+    for node in nodes.get(code.co_firstlineno, ()):
+        target = node.generators[0].target
+        if isinstance(target, ast.Name):
+            names = (target.id,)
+        elif isinstance(target, ast.Tuple):
+            names = tuple(getattr(e, "id", None) for e in target.elts)
+        else:
+            continue
+        if varnames[:len(names)] == names \
+                and all(_covers(node, p) for p in positions):
+            candidates.append(node)
+    if not candidates:
+        return None
+    return min(candidates, key=lambda n: (n.end_lineno - n.lineno,
+                                          n.end_col_offset - n.col_offset))
+
+
+# Compile a function with the given body. It is nested in a function that
+# have the given free variables as arguments, so the body loads them as in
+# the generator.
+def _compile_function(code, node, name, varnames, body, freevars=None):
+    if freevars is None:
+        freevars = code.co_freevars
+    module = ast.parse("def outer(%s):\n    def inner(%s): pass" % (
+        ", ".join(freevars), ", ".join(varnames)))
+    for n in ast.walk(module):
+        if hasattr(n, "lineno"):
+            ast.copy_location(n, node)
+    inner = module.body[0].body[0]
+    inner.name = name
+    inner.body = body
+    module = ast.fix_missing_locations(module)
+    outer = compile(module, code.co_filename, "exec").co_consts[0]
+    return next(c for c in outer.co_consts
+                if isinstance(c, types.CodeType) and c.co_name == name)
+
+
+# The variables of a generator code and if they are a tuple, taken from the
+# instructions that store the item of the loop
+def _loop_target(code):
+    instructions = dis.get_instructions(code)
+    for i in instructions:
+        if i.opname == "FOR_ITER":
+            break
+    i = next(instructions)
+    count = i.arg if i.opname == "UNPACK_SEQUENCE" else None
+    if count is not None:
+        i = next(instructions)
+    names = []
+    while len(names) < (count or 1) and i.opname.startswith("STORE_FAST"):
+        if i.opname == "STORE_FAST_LOAD_FAST":
+            names.append(i.argval[0])
+        else:
+            names.extend(i.argval if isinstance(i.argval, tuple)
+                         else (i.argval,))
+        i = next(instructions)
+    if len(names) != (count or 1):
+        raise TypeError("The variables must be names or a tuple of names.")
+    return tuple(names), count is not None
+
+
+# Build the expression of a generator without source. See NOTE 2
+def _code_expression(code):
+    varnames, packed = _loop_target(code)
+    element = "(%s,)" % ", ".join(varnames) if packed else varnames[0]
+    node = ast.parse("for __value in %s(iter((%s,))):\n    return __value"
+                     % (_GENERATOR, element)).body[0]
+    ast.increment_lineno(node, code.co_firstlineno - 1)
+
+    def function(accepted, rejected):
+        loop = copy.deepcopy(node)
+        loop.body[0].value = accepted
+        return [loop, rejected]
+    rejected = ast.parse("raise ValueError('Variable do not satisfy the "
+                         "constraint.')").body[0]
+    return _Expression(varnames, *[_compile_function(
+        code, node, name, varnames, body, (_GENERATOR,)) for name, body in [
+            ("<member>", function(ast.Name("__value", ast.Load()), rejected)),
+            ("<constraint>", function(ast.Constant(True),
+                                      ast.Return(ast.Constant(False)))),
+            ("<function>", function(ast.Name("__value", ast.Load()),
+                                    ast.Return(ast.Constant(numpy.nan))))]])
+
+
+def _parse_generator(generator):
+    code = generator.gi_code
+    node = _generator_node(code)
+    if node is None:
+        return _code_expression(code)
+    if len(node.generators) != 1 or node.generators[0].is_async:
+        raise TypeError("Only one 'for' clause is supported.")
+    varnames = _target_names(node.generators[0].target)
+    ifs = node.generators[0].ifs
+    if len(ifs) > 1:
+        condition = ast.copy_location(ast.BoolOp(ast.And(), ifs), node)
     else:
-        new_start = ns
+        condition = ifs[0] if ifs else ast.Constant(True)
+    function = [ast.Return(node.elt)]
+    if ifs:
+        function = [ast.If(condition, function, []),
+                    ast.Return(ast.Constant(numpy.nan))]
+    expression = _Expression(
+        varnames,
+        _compile_function(code, node, "<member>", varnames,
+                          [ast.Return(node.elt)]),
+        _compile_function(code, node, "<constraint>", varnames,
+                          [ast.Return(condition)]),
+        _compile_function(code, node, "<function>", varnames, function))
+    traces = _expression_traces(node, varnames, code.co_freevars)
+    _TRACES[expression.member], _TRACES[expression.constraint] = traces
+    return expression
+
+
+# Get the parsed generator expression from the cache
+def _expression(generator):
+    return code_cache.lookup(generator, "expression", _parse_generator)
+
+
+# The cells of the free variables of a generator. They are in the closure of
+# the function that made the generator, that only the garbage collector sees.
+def _generator_cells(generator):
+    code = generator.gi_code
+    if not code.co_freevars:
+        return {}
+    for r in gc.get_referents(generator):
+        if isinstance(r, types.FunctionType) and r.__code__ is code \
+                and r.__closure__:
+            return dict(zip(code.co_freevars, r.__closure__))
+    values = generator.gi_frame.f_locals
+    return {n: types.CellType(values[n]) for n in code.co_freevars}
+
+
+# Create a function object with the given code. The code is taken from the
+# cache, only the globals and the free variables are new in each call.
+def _bind(generator, code, name):
+    namespace = generator.gi_frame.f_globals
+    cells = _generator_cells(generator)
+    if _GENERATOR in code.co_freevars:
+        closure = tuple(cells[n] for n in generator.gi_code.co_freevars)
+        cells[_GENERATOR] = types.CellType(types.FunctionType(
+            generator.gi_code, namespace, None, None, closure or None))
+    closure = tuple(cells[n] for n in code.co_freevars)
+    return types.FunctionType(code, namespace, name, None, closure or None)
 
-    for i in old_bytecode[new_start + 1:]:   # remove the loop initialization
 
-        # Replace YIELD_VALUE  by RETURN_VALUE bytecode because
-        # the new code will be a function, not a generator
-        if isinstance(i, bytecode.Instr) and i.name == "YIELD_VALUE":
-            new_bytecode.append(bytecode.Instr("RETURN_VALUE"))
-            break  # the new code ends when return the value
-        new_bytecode.append(i)
-
-    # NOTE 2: generator.gi_code.co_varnames everytime contains
-    # the ".0" constant. The another names are the variable names used by the
-    # generator. That varnames will be the arguments of the new function.
-    new_bytecode.varnames = generator.gi_code.co_varnames[:1]
-    new_bytecode.argcount = len(new_bytecode.varnames)
-
-    return new_bytecode
+def get_member(generator):
+    "Create a function with the member of the generator (see NOTE 1)."
+    return _bind(generator, _expression(generator).member, "<member>")
 
 
-# Create a function object with the given bytecode
-def _bytecode_to_function(generator, byte_code, name):
-    new_code = byte_code.to_code()
-    new_globals = generator.gi_frame.f_globals
-    return types.FunctionType(new_code, new_globals, name)
+def get_constraints(generator):
+    "Create a function that check the constraints of the generator."
+    return _bind(generator, _expression(generator).constraint,
+                 "<constraint>")
 
 
-def get_member(generator):
-    "Extract the member bytecode (see NOTE 1) and create a function with it."
-    fun_bytecode = _get_member_bytecode(generator)
-    return _bytecode_to_function(generator, fun_bytecode, "<member>")
-
-
-# Get the constraint bytecode of the generator expression
-def _get_constraints_bytecode(generator):
-    old_bytecode = bytecode.Bytecode.from_code(generator.gi_code)
-    new_bytecode = bytecode.Bytecode()
-    new_start = _get_new_start(old_bytecode)
-    end_label = bytecode.Label()
-
-    # Count the amount of POP_JUMP_IF_FALSE bytecodes
-    pjif_count = 0
-    for b in old_bytecode:
-        if isinstance(b, bytecode.Instr) and b.name == "POP_JUMP_IF_FALSE":
-            pjif_count += 1
-
-    for b in old_bytecode[new_start:]:   # remove the loop initialization
-        if isinstance(b, bytecode.Instr) and b.name == "POP_JUMP_IF_FALSE":
-            pjif_count -= 1
-            if pjif_count:
-                new_bytecode.append(bytecode.Instr("JUMP_IF_FALSE_OR_POP",
-                                                   end_label, lineno=b.lineno))
-                continue
-            else:
-                new_bytecode.append(end_label)
-                new_bytecode.append(bytecode.Instr("RETURN_VALUE"))
-                break
-        new_bytecode.append(b)
+def generator_to_function(generator):
+    """Create a function object with the generator expression object."""
+    return _bind(generator, _expression(generator).function, "<function>")
 
-    new_bytecode.varnames = generator.gi_code.co_varnames[:1]  # See NOTE 2
-    new_bytecode.argcount = len(new_bytecode.varnames)
-    return new_bytecode
 
+# Replace the free variables of an expression tree by constants with the
+# values of their cells
+def _bind_free(node, cells, cache):
+    if id(node) in cache:
+        return cache[id(node)]
+    if node.op == "free":
+        result = _Node("const", (cells[node.args[0]].cell_contents,))
+    else:
+        result = _Node(node.op, tuple(
+            _bind_free(a, cells, cache) if isinstance(a, _Node) else a
+            for a in node.args))
+    cache[id(node)] = result
+    return result
+
+
+# Return the expression tree of a function made by the front end or None if
+# the code can not be vectorized. The free variables are bound to the values
+# that they have now. See NOTE 3
+def _trace(function):
+    code = function.__code__
+    trace = _TRACES.get(code)
+    if trace is None or not code.co_freevars:
+        return trace
+    cells = dict(zip(code.co_freevars, function.__closure__))
+    cache = {}
+    try:
+        return _Trace(
+            tuple(_bind_free(c, cells, cache) for c in trace.conjuncts),
+            _bind_free(trace.value, cells, cache))
+    except ValueError:
+        return None  # a free variable is not assigned yet
+
+
+def _load_global(namespace, name):
+    try:
+        return namespace[name]
+    except KeyError:
+        return getattr(builtins, name)
+
+
+# Raise _Unsupported if an integer operation wrapped around. NumPy does not
+# report the integer overflow, so the operation is repeated with floats,
+# that do not wrap, and its bounds are compared with the integer type.
+def _check_overflow(symbol, left, right, value):
+    if symbol not in ("+", "-", "*", "**", "<<") \
+            or not isinstance(value, numpy.ndarray) \
+            or value.dtype.kind not in "iu" or not value.size:
+        return
+    left = numpy.asarray(left, dtype=numpy.float64)
+    right = numpy.asarray(right, dtype=numpy.float64)
+    with numpy.errstate(all="ignore"):
+        if symbol == "<<":
+            exact = left * numpy.exp2(right)
+        else:
+            exact = _BINARY_OPERATORS[symbol](left, right)
+    bounds = numpy.iinfo(value.dtype)
+    if not (numpy.all(exact >= bounds.min) and numpy.all(exact < bounds.max)):
+        raise _Unsupported("Integer overflow.")
+
+
+# Evaluate an expression tree with whole arrays as variables. The cache
+# avoid evaluate twice the nodes shared by a chained comparison.
+def _evaluate(node, columns, namespace, cache):
+    key = id(node)
+    if key in cache:
+        return cache[key]
+    op, args = node
+    if op == "var":
+        value = _widen(columns[args[0]])
+    elif op == "const":
+        value = args[0]
+        if isinstance(value, abc.Iterable) \
+                and not isinstance(value, (str, bytes)):
+            raise _Unsupported("Only scalar constants are supported.")
+    elif op == "global":
+        value = _load_global(namespace, args[0])
+    elif op == "attr":
+        obj = _evaluate(args[0], columns, namespace, cache)
+        if isinstance(obj, numpy.ndarray):
+            raise _Unsupported("Attributes of variables are not supported.")
+        value = getattr(obj, args[1])
+    elif op == "call":
+        function = _evaluate(args[0], columns, namespace, cache)
+        function = _VECTORIZED_BUILTINS.get(function, function) \
+            if isinstance(function, abc.Hashable) else function
+        if not isinstance(function, numpy.ufunc):
+            raise _Unsupported("Only NumPy ufuncs can be called.")
+        value = function(*[_evaluate(a, columns, namespace, cache)
+                           for a in args[1:]])
+    elif op == "binary":
+        left = _evaluate(args[1], columns, namespace, cache)
+        right = _evaluate(args[2], columns, namespace, cache)
+        value = _BINARY_OPERATORS[args[0]](left, right)
+        _check_overflow(args[0], left, right, value)
+    elif op == "compare":
+        value = _COMPARE_OPERATORS[args[0]](
+            _evaluate(args[1], columns, namespace, cache),
+            _evaluate(args[2], columns, namespace, cache))
+    elif op == "unary":
+        value = _UNARY_OPERATORS[args[0]](
+            _evaluate(args[1], columns, namespace, cache))
+    elif op == "tuple":
+        value = tuple(_evaluate(a, columns, namespace, cache) for a in args)
+    else:
+        raise _Unsupported("Unknown node %r." % op)
+    cache[key] = value
+    return value
+
+
+# Convert the value of a conjunct to a boolean mask of the given size
+def _as_mask(value, size):
+    value = numpy.asarray(value)
+    if value.dtype.kind not in "biuf":
+        raise _Unsupported("The constraint is not numeric.")
+    return numpy.broadcast_to(value.astype(bool, copy=False), (size,))
+
+
+# Convert the value of the member to an array of the given size
+def _as_elements(value, size):
+    if isinstance(value, tuple):
+        columns = [numpy.broadcast_to(v, (size,)) for v in value]
+        return _stack_columns(columns)
+    if numpy.ndim(value) == 0:
+        return numpy.array([value]*size)
+    if numpy.shape(value) != (size,):
+        raise _Unsupported("The member does not return one value per row.")
+    return numpy.asarray(value)
+
+
+# Get the rest of the sequence of an iterator without consume it. Return
+# None if the iterator is not over a list, a tuple, a range or an array.
+def _iterator_sequence(iterator):
+    if isinstance(iterator, (_ConstrainedSet, _DomainIterator)):
+        iterator = iterator.elements
+    try:
+        function, args, *state = iterator.__reduce__()
+    except TypeError:
+        return None
+    if function is iter and len(args) == 1 \
+            and isinstance(args[0], (range, list, tuple, numpy.ndarray)):
+        return args[0][state[0] if state else 0:]
+    return None
+
+
+def _sequence_array(sequence):
+    if isinstance(sequence, range):
+        return numpy.arange(sequence.start, sequence.stop, sequence.step)
+    return numpy.asarray(sequence)
+
+
+# Get the domain of a generator as a list of arrays, one per variable,
+# without consume it. Return None if the domain is not array-like.
+def _domain_columns(domain, count):
+    if isinstance(domain, (_ConstrainedSet, _DomainIterator)):
+        domain = domain.elements
+    try:
+        function, args, *state = domain.__reduce__()
+    except TypeError:
+        return None
+    if function is zip and count > 1 and len(args) == count:
+        columns = [_domain_columns(a, 1) for a in args]
+        if None in columns:
+            return None
+        size = min(len(c[0]) for c in columns)
+        return [c[0][:size] for c in columns]
+    sequence = _iterator_sequence(domain)
+    if sequence is None:
+        return None
+    array = _sequence_array(sequence)
+    if count == 1 and array.ndim == 1:
+        return [array]
+    if count > 1 and (array.ndim == 2 and array.shape[1] == count
+                      or len(array.dtype.names or ()) == count):
+        return _row_columns(array)
+    return None
+
+
+def _object_column(values):
+    values = list(values)
+    try:
+        column = numpy.array(values)
+    except ValueError:
+        column = None
+    if column is None or column.ndim != 1:
+        column = numpy.empty(len(values), dtype=object)
+        column[:] = values
+    return column
+
+
+# Convert a block of the domain to a list of columns, one per variable. The
+# values that are not numbers are kept in object arrays.
+def _block_columns(block, count):
+    if count == 1:
+        if isinstance(block, numpy.ndarray) and block.ndim == 1:
+            return [block]
+        return [_object_column(block)]
+    if isinstance(block, numpy.ndarray) \
+            and (block.ndim == 2 and block.shape[1] == count
+                 or len(block.dtype.names or ()) == count):
+        return _row_columns(block)
+    return [_object_column(c) for c in zip(*block)]
+
+
+# Get the sequences of a zip over sequences, one per variable
+def _zip_sequences(domain, count):
+    if isinstance(domain, (_ConstrainedSet, _DomainIterator)):
+        domain = domain.elements
+    try:
+        function, args, *state = domain.__reduce__()
+    except TypeError:
+        return None
+    if function is not zip or count == 1 or len(args) != count:
+        return None
+    sequences = [_iterator_sequence(a) for a in args]
+    if any(s is None or _sequence_array(s[:1]).ndim != 1 for s in sequences):
+        return None
+    return sequences
+
+
+# Yield the domain of a generator as lists of columns with "size" rows at
+# most. The sequences are sliced, any other iterator is consumed.
+def _domain_blocks(domain, count, size):
+    sequences = _zip_sequences(domain, count)
+    if sequences is not None:
+        length = min(len(s) for s in sequences)
+        for start in range(0, length, size):
+            yield [_sequence_array(s[start:start + size]) for s in sequences]
+        return
+    sequence = _iterator_sequence(domain)
+    if sequence is not None:
+        for start in range(0, len(sequence), size):
+            block = sequence[start:start + size]
+            if isinstance(block, range):
+                block = _sequence_array(block)
+            yield _block_columns(block, count)
+        return
+    if isinstance(domain, _ProductIterator) and domain.iterator is None \
+            and count == len(domain.stream.sets):
+        yield from domain.stream.column_blocks(size)
+        return
+    if isinstance(domain, _StreamIterator) and domain.iterator is None:
+        blocks = domain.stream.iter_chunks(size)
+    else:
+        blocks = iter(lambda: list(itertools.islice(domain, size)), [])
+    for block in blocks:
+        yield _block_columns(block, count)
+
+
+# Evaluate the constraints and the member with whole arrays. Return the mask
+# of the rows that satisfy all the constraints and the member values of that
+# rows. Raise an exception if the code can not be vectorized.
+def _vectorized_call(member, constraints, columns):
+    member_trace = _trace(member)
+    if member_trace is None or member_trace.conjuncts:
+        raise _Unsupported("The member can not be vectorized.")
+    size = len(columns[0])
+    # Errors are raised to take the element by element path, that way
+    # "x // 0" fails as it does in python instead of return zeros.
+    with numpy.errstate(all="raise", under="ignore"):
+        mask = numpy.ones(size, dtype=bool)
+        for constraint in constraints:
+            trace = _trace(constraint)
+            if trace is None:
+                raise _Unsupported("The constraint can not be vectorized.")
+            cache = {}
+            for node in trace.conjuncts + (trace.value,):
+                value = _evaluate(node, columns, constraint.__globals__, cache)
+                mask &= _as_mask(value, size)
+        if not mask.all():
+            columns = [c[mask] for c in columns]
+        value = _evaluate(member_trace.value, columns, member.__globals__, {})
+        return mask, _as_elements(value, len(columns[0]))
+
+
+def vectorized_elements(member, constraint, domain, count):
+    """Evaluate the member and the constraint with whole arrays.
+
+    Return the array of the elements that satisfy the constraint or None if
+    the functions or the domain can not be vectorized.
+    """
+    columns = _domain_columns(domain, count)
+    if not columns or len(columns[0]) == 0:
+        return None
+    try:
+        return _vectorized_call(member, [constraint], columns)[1]
+    except Exception:
+        return None
+
+
+# Put the values of the selected rows in an array with one row per mask item.
+# The rejected rows are masked or filled with NaN.
+def _fill_rejected(values, mask, masked):
+    shape = (len(mask),) + values.shape[1:]
+    if masked:
+        data = numpy.zeros(shape, dtype=values.dtype)
+        data[mask] = values
+        rejected = ~mask.reshape((-1,) + (1,)*(len(shape) - 1))
+        return numpy.ma.masked_array(
+            data, mask=numpy.broadcast_to(rejected, shape))
+    if values.dtype.kind in "biufc":
+        dtype = numpy.promote_types(values.dtype, float)
+    else:
+        dtype = object
+    data = numpy.full(shape, numpy.nan, dtype=dtype)
+    data[mask] = values
+    return data
 
-# Check if the generator expression has the constraint part
-def _has_constraints(generator):
-    for i, op_code in enumerate(generator.gi_code.co_code):
-        if i%2 == 0 and op_code == opcode.opmap["POP_JUMP_IF_FALSE"]:
-            return True
-    return False
 
+# NOTE 7: If the domain is a range, the member is affine and the constraints
+# are bounds or congruences, the set is an arithmetic progression. The set
+# keeps it as a Progression object and answer the membership, the length and
+# the set operations with integer arithmetic, without compute the elements.
+#
+#     Set(3*x + 1 for x in range(100) if x % 4 == 0)
+#         ──>  x in range(0, 100, 4)  ──>  Progression(range(1, 301, 12))
+
+
+# Max amount of ranges in the difference of two ranges
+_MAX_PIECES = 64
+
+
+def _modular_inverse(a, m):
+    r0, r1, s0, s1 = a % m, m, 1, 0
+    while r1:
+        q = r0 // r1
+        r0, r1, s0, s1 = r1, r0 - q*r1, s1, s0 - q*s1
+    return s0 % m
+
+
+# Return the range with positive step and the same elements
+def _ascending(r):
+    return r if r.step > 0 else r[::-1]
+
+
+# Intersection of two ranges with positive steps. Use the chinese remainder
+# theorem to find the first common element.
+def _range_intersection(r1, r2):
+    if not r1 or not r2:
+        return range(0)
+    g = math.gcd(r1.step, r2.step)
+    if (r2.start - r1.start) % g:
+        return range(0)
+    m = r2.step // g
+    k = (r2.start - r1.start) // g * _modular_inverse(r1.step // g, m) % m
+    step = r1.step * m
+    low = max(r1[0], r2[0])
+    first = low + (r1.start + r1.step*k - low) % step
+    return range(first, min(r1[-1], r2[-1]) + 1, step)
+
+
+# Difference of two ranges with positive steps as a list of ranges. Return
+# None if the result need too many ranges.
+def _range_difference(r1, r2):
+    common = _range_intersection(r1, r2)
+    if not common:
+        return [r1]
+    if common.step // r1.step > _MAX_PIECES:
+        return None
+    pieces = [range(r1[0], common[0], r1.step),
+              range(common[-1] + r1.step, r1[-1] + 1, r1.step)]
+    for j in range(1, common.step // r1.step):
+        pieces.append(range(common[0] + j*r1.step, common[-1], common.step))
+    return [p for p in pieces if p]
+
+
+class Progression:
+    """A set of integers made of disjoint arithmetic progressions."""
+    def __init__(self, *ranges):
+        self.ranges = tuple(r for r in ranges if r)
+
+    def __len__(self):
+        return sum(len(r) for r in self.ranges)
+
+    def __contains__(self, value):
+        try:
+            value = operator.index(value)
+        except TypeError:
+            if not (isinstance(value, float) and value.is_integer()):
+                return False
+            value = int(value)
+        return any(value in r for r in self.ranges)
 
-# Get the constraint part of the generator expression and
-# make a function with it. Create a function that everytime
-# return True if the generator have not constraints.
-def get_constraints(generator):
-    if _has_constraints(generator):
-        fun_bytecode = _get_constraints_bytecode(generator)
-    else:
-        fun_bytecode = bytecode.Bytecode([
-            bytecode.Instr("LOAD_CONST", True),
-            bytecode.Instr("RETURN_VALUE")])
-    fun_bytecode.varnames = generator.gi_code.co_varnames[1:]  # See NOTE 2
-    fun_bytecode.argcount = len(fun_bytecode.varnames)
-    return _bytecode_to_function(generator, fun_bytecode, "<constraint>")
-
-
-# Create a function bytecode with the generator expression bytecode.
-def _generator_to_function_bytecode(generator):
-    old_bytecode = bytecode.Bytecode.from_code(generator.gi_code)
-    new_bytecode = bytecode.Bytecode()
-    new_end_label = _get_new_end_label(old_bytecode)
-    old_end_label = _get_old_end_label(old_bytecode)
-    new_start = _get_new_start(old_bytecode)
-
-    for i in old_bytecode[new_start:]:   # remove the loop initialization
-        if isinstance(i, bytecode.Instr):
-            # Return the element that satisfy the constraint
-            if i.name == "YIELD_VALUE":
-                new_bytecode.append(bytecode.Instr("RETURN_VALUE", i.arg))
-
-            # remove jump that go to the start of the loop
-            elif i.name in ("POP_TOP", "JUMP_ABSOLUTE", "UNPACK_SEQUENCE"):
-                continue
-            else:
-                new_bytecode.append(bytecode.Instr(i.name, i.arg))
-        else:
-            # jump to end if element not satisfy the constraint
-            if i == old_end_label:
-                new_bytecode.append(new_end_label)
-            else:
-                new_bytecode.append(i)
+    def __iter__(self):
+        return itertools.chain.from_iterable(self.ranges)
+
+    def to_array(self):
+        """Return the elements as an array, in the order of the ranges."""
+        if not self.ranges:
+            return numpy.array([])
+        bounds = [v for r in self.ranges for v in (r[0], r[-1])]
+        dtype = _integer_dtype(min(bounds), max(bounds))
+        return numpy.concatenate([numpy.arange(r.start, r.stop, r.step,
+                                               dtype=dtype)
+                                  for r in self.ranges])
 
-    # return math.nan if element not satisfy the constraint
-    new_bytecode[-2] = bytecode.Instr("LOAD_CONST", numpy.nan)
-    new_bytecode.varnames = generator.gi_code.co_varnames[1:]  # See NOTE 2
-    new_bytecode.argcount = len(new_bytecode.varnames)
+    def intersection(self, other):
+        return Progression(*[
+            _range_intersection(_ascending(a), _ascending(b))
+            for a in self.ranges for b in other.ranges])
 
-    return new_bytecode
+    def difference(self, other):
+        pieces = [_ascending(r) for r in self.ranges]
+        for b in other.ranges:
+            new_pieces = []
+            for a in pieces:
+                result = _range_difference(a, _ascending(b))
+                if result is None:
+                    return None
+                new_pieces.extend(result)
+            pieces = new_pieces
+        return Progression(*pieces)
 
+    def union(self, other):
+        rest = other.difference(self)
+        return None if rest is None else Progression(*self.ranges,
+                                                     *rest.ranges)
 
-def generator_to_function(generator):
-    """Create a function object with the generator expression object."""
-    fun_bytecode = _generator_to_function_bytecode(generator)
-    return _bytecode_to_function(generator, fun_bytecode, "<function>")
+    def symmetric_difference(self, other):
+        left = self.difference(other)
+        right = other.difference(self)
+        if left is None or right is None:
+            return None
+        return Progression(*left.ranges, *right.ranges)
+
+
+# Return the (a, b) coefficients of an affine expression "a*x + b" of a
+# single integer variable or None if the expression is not affine.
+def _affine(node):
+    op, args = node
+    if op == "var":
+        return (1, 0)
+    elif op == "const":
+        value = args[0]
+        return (0, value) if isinstance(value, int) else None
+    elif op == "unary" and args[0] in "+-":
+        inner = _affine(args[1])
+        if inner is None:
+            return None
+        return inner if args[0] == "+" else (-inner[0], -inner[1])
+    elif op == "binary" and args[0] in ("+", "-", "*"):
+        left, right = _affine(args[1]), _affine(args[2])
+        if left is None or right is None:
+            return None
+        if args[0] == "+":
+            return (left[0] + right[0], left[1] + right[1])
+        elif args[0] == "-":
+            return (left[0] - right[0], left[1] - right[1])
+        elif left[0] == 0 or right[0] == 0:
+            return (left[0]*right[1] + right[0]*left[1], left[1]*right[1])
+    return None
+
+
+_REVERSED_COMPARISON = {"<": ">", "<=": ">=", ">": "<", ">=": "<=",
+                        "==": "==", "!=": "!="}
+
+
+# Return the range of the elements of the ascending range that satisfy the
+# conjunct or None if the conjunct is not a bound or a congruence.
+def _conjunct_range(node, domain):
+    if node.op == "const":
+        return domain if node.args[0] else range(0)
+    if node.op != "compare":
+        return None
+    symbol, left, right = node.args
+    if left.op == "const":
+        symbol, left, right = _REVERSED_COMPARISON[symbol], right, left
+    if right.op != "const" or isinstance(right.args[0], bool) \
+            or not isinstance(right.args[0], (int, float)):
+        return None
+    value = right.args[0]
+
+    # (a*x + b) % k == r  ──>  x ≡ x0 (mod m)
+    if left.op == "binary" and left.args[0] == "%":
+        inner, modulo = _affine(left.args[1]), _affine(left.args[2])
+        if inner is None or modulo is None or modulo[0] != 0 \
+                or modulo[1] <= 0 or not isinstance(value, int):
+            return None
+        k = modulo[1]
+        if symbol == "!=" and k == 2 and value in (0, 1):
+            symbol, value = "==", 1 - value
+        if symbol != "==":
+            return None
+        if not 0 <= value < k:
+            return range(0)
+        a, b = inner
+        g = math.gcd(a, k)
+        if (value - b) % g:
+            return range(0)
+        m = k // g
+        x0 = (value - b) // g * _modular_inverse(a // g, m) % m
+        first = domain[0] + (x0 - domain[0]) % m
+        return _range_intersection(domain, range(first, domain[-1] + 1, m))
+
+    # a*x + b < c  ──>  x < (c - b)/a
+    coefficients = _affine(left)
+    if coefficients is None:
+        return None
+    a, b = coefficients
+    if a == 0:
+        return domain if _COMPARE_OPERATORS[symbol](b, value) else range(0)
+    if a < 0:
+        symbol = _REVERSED_COMPARISON[symbol]
+    bound = fractions.Fraction(value - b) / a
+    low, high = domain[0], domain[-1]
+    if symbol == ">":
+        low = max(low, math.floor(bound) + 1)
+    elif symbol == ">=":
+        low = max(low, math.ceil(bound))
+    elif symbol == "<":
+        high = min(high, math.ceil(bound) - 1)
+    elif symbol == "<=":
+        high = min(high, math.floor(bound))
+    elif symbol == "==":
+        if bound.denominator != 1:
+            return range(0)
+        low, high = max(low, int(bound)), min(high, int(bound))
+    else:
+        return None
+    return _range_intersection(domain, range(low, high + 1))
+
+
+def range_progression(member, constraint, domain):
+    """Return the elements of the set as a Progression object or None.
+
+    The domain must be a range iterator, the member an affine function and
+    the constraints bounds or congruences. See NOTE 7.
+    """
+    try:
+        function, args, *state = domain.__reduce__()
+    except TypeError:
+        return None
+    if function is not iter or not isinstance(args[0], range):
+        return None
+    member_trace = _trace(member)
+    constraint_trace = _trace(constraint)
+    if member_trace is None or member_trace.conjuncts \
+            or constraint_trace is None \
+            or member.__code__.co_argcount != 1:
+        return None
+    coefficients = _affine(member_trace.value)
+    if coefficients is None or coefficients[0] == 0:
+        return None  # a constant member repeat the same element
+    original = args[0][state[0] if state else 0:]
+    values = _ascending(original)
+    for node in constraint_trace.conjuncts + (constraint_trace.value,):
+        if not values:
+            break
+        values = _conjunct_range(node, values)
+        if values is None:
+            return None
+    if original.step < 0:
+        values = values[::-1]
+    a, b = coefficients
+    if not values:
+        return Progression()
+    start = a*values.start + b
+    return Progression(range(start, start + a*values.step*len(values),
+                             a*values.step))
 
 
 # A decorator that ensure that ".elements" property is not none and if full.
 def _ensure_elements(method):
     @functools.wraps(method)
     def wrapper(self, other):
-        if self.elements is None:
-            iter(self)
-        if other.elements is None:
-            iter(other)
+        _get_elements(self)
+        _get_elements(other)
         return method(self, other)
     return wrapper
 
 
+# NOTE 20: The elements are kept in the narrowest type that holds them
+# without loss: the integers in the smallest signed type for their bounds,
+# that are known without a scan for the progressions, and the floats in
+# float32 if no value changes. The columns are widened to 64 bits before any
+# arithmetic in the vectorized engine and the iterators of the sets give
+# 64 bits scalars, so the narrow types never overflow in a member or a
+# constraint. The set operations promote the types of their operands.
+
+
+_INTEGER_TYPES = (numpy.int8, numpy.int16, numpy.int32, numpy.int64)
+
+_WIDE_TYPES = {numpy.dtype(t): numpy.dtype(numpy.int64)
+               for t in (numpy.int8, numpy.int16, numpy.int32, numpy.uint8,
+                         numpy.uint16, numpy.uint32)}
+_WIDE_TYPES.update({numpy.dtype(numpy.float16): numpy.dtype(numpy.float64),
+                    numpy.dtype(numpy.float32): numpy.dtype(numpy.float64)})
+
+
+def _integer_dtype(low, high):
+    for t in _INTEGER_TYPES:
+        info = numpy.iinfo(t)
+        if info.min <= low and high <= info.max:
+            return numpy.dtype(t)
+    return numpy.result_type(numpy.min_scalar_type(low),
+                             numpy.min_scalar_type(high))
+
+
+# Convert values to the narrowest lossless array or to the given dtype
+def _compact(values, dtype=None):
+    if dtype is not None:
+        return numpy.asarray(values, dtype=dtype)
+    elements = _element_array(values) if isinstance(values, (list, tuple)) \
+        else numpy.asarray(values)
+    if elements.dtype == object and len(elements):
+        try:
+            numbers = numpy.array(elements.tolist())
+        except ValueError:
+            numbers = elements
+        if numbers.dtype.kind in "biuf":
+            elements = numbers
+    if not elements.size:
+        return elements
+    if elements.dtype.kind in "iu":
+        dtype = _integer_dtype(int(elements.min()), int(elements.max()))
+        return elements.astype(dtype, copy=False)
+    if elements.dtype.kind == "f" and elements.dtype.itemsize > 4:
+        with numpy.errstate(over="ignore"):
+            narrow = elements.astype(numpy.float32)
+        if numpy.array_equal(narrow, elements, equal_nan=True):
+            return narrow
+    return elements
+
+
+def _widen(array):
+    if isinstance(array, numpy.ndarray) and array.dtype in _WIDE_TYPES:
+        return array.astype(_WIDE_TYPES[array.dtype])
+    return array
+
+
+# Iterate an array with the wide types. The values are widened one block at
+# a time and "elements" is an iterator over the rest of the array, so the
+# engines can still take the rest as a whole array.
+class _ArrayIterator:
+    array = None
+    position = 0
+    values = iter(())
+
+    @property
+    def elements(self):
+        return iter(self.array[self.position:])
+
+    def __next__(self):
+        for value in self.values:
+            self.position += 1
+            return value
+        array = self.array
+        if self.position >= len(array):
+            raise StopIteration
+        block = _widen(array[self.position:self.position + _BLOCK])
+        self.values = iter(block.tolist() if block.dtype.names else block)
+        return next(self)
+
+    def __iter__(self):
+        return self
+
+
+# NOTE 5: A canonical array is sorted and has not duplicates. The sets with
+# the "canonical" flag keep their elements that way and the set operations
+# work over canonical arrays, so they never sort again. The membership test
+# is a binary search and the union of k sorted arrays is a merge, because
+# the stable sort of NumPy is a timsort that detects the sorted runs.
+
+
+# Get the columns of an array of rows, a 2-D array or a structured array
+def _row_columns(array):
+    if array.dtype.names:
+        return [array[name] for name in array.dtype.names]
+    return list(array.T)
+
+
+def _records(columns):
+    records = numpy.empty(len(columns[0]), dtype=[
+        ("f%d" % i, c.dtype) for i, c in enumerate(columns)])
+    for i, c in enumerate(columns):
+        records["f%d" % i] = c
+    return records
+
+
+# Join columns in an array with a row by element. The columns of different
+# kinds are kept in a structured array with a field by column, so each one
+# keeps its type: the rows of (1, "a") are not converted to ("1", "a") and
+# the rows of (1, 0.5) do not convert the integers to floats.
+def _stack_columns(columns):
+    columns = [numpy.asarray(c) for c in columns]
+    if len({c.dtype.kind for c in columns}) == 1:
+        return numpy.column_stack(columns)
+    return _records(columns)
+
+
+# Convert a list of elements to an array. The tuples of the same length are
+# rows, see _stack_columns.
+def _element_array(values):
+    values = list(values)
+    if values and all(isinstance(v, tuple) for v in values) \
+            and len(values[0]) and len(set(map(len, values))) == 1:
+        return _stack_columns([_object_column(c) for c in zip(*values)])
+    return numpy.array(values)
+
+
+# View the rows of 2-D arrays as a 1-D structured arrays with a field by
+# column, so the rows are sorted, searched and compared as single values in
+# lexicographic order. The arrays are cast to a common type first, field by
+# field if some of them are structured arrays.
+def _row_keys(*arrays):
+    if all(a.ndim == 1 and not a.dtype.names for a in arrays):
+        return arrays
+    if any(a.dtype.names for a in arrays):
+        if any(a.ndim != (1 if a.dtype.names else 2) for a in arrays) \
+                or len({len(_row_columns(a)) for a in arrays}) > 1:
+            raise ValueError("The elements have different dimensions.")
+        arrays = [_records(_row_columns(a)) for a in arrays]
+        try:
+            dtype = numpy.result_type(*arrays)
+        except TypeError:
+            raise ValueError("The elements have different types.")
+        return tuple(a.astype(dtype, copy=False) for a in arrays)
+    if any(a.ndim != 2 for a in arrays) \
+            or len({a.shape[1] for a in arrays}) > 1:
+        raise ValueError("The elements have different dimensions.")
+    dtype = numpy.result_type(*arrays)
+    fields = [("f%d" % i, dtype) for i in range(arrays[0].shape[1])]
+    return tuple(numpy.ascontiguousarray(a, dtype=dtype).view(fields)[:, 0]
+                 for a in arrays)
+
+
+# Mask of the elements of the array that are in the canonical array
+def _sorted_isin(array, canonical):
+    if len(canonical) == 0:
+        return numpy.zeros(len(array), dtype=bool)
+    try:
+        array, canonical = _row_keys(array, canonical)
+    except ValueError:
+        return numpy.zeros(len(array), dtype=bool)
+    if array.dtype != canonical.dtype and array.dtype.kind in "biuf" \
+            and canonical.dtype.kind in "biuf":
+        # Only the probe is cast, the canonical array may be a large memmap
+        dtype = numpy.result_type(array, canonical)
+        if dtype != canonical.dtype and canonical.dtype.kind in "iu" \
+                and array.dtype.kind in "iuf":
+            return _narrow_isin(array, canonical)
+        array = array.astype(dtype)
+        canonical = canonical.astype(dtype, copy=False)
+    index = numpy.searchsorted(canonical, array)
+    index[index == len(canonical)] = 0
+    return canonical[index] == array
+
+
+# The values out of the range of the integer type of the canonical array are
+# not in it, the other values are cast to that type
+def _narrow_isin(array, canonical):
+    info = numpy.iinfo(canonical.dtype)
+    with numpy.errstate(invalid="ignore"):
+        inside = (array >= info.min) & (array <= info.max)
+        if array.dtype.kind == "f":
+            inside &= numpy.floor(array) == array
+    probe = numpy.where(inside, array, canonical[0]).astype(canonical.dtype)
+    return _sorted_isin(probe, canonical) & inside
+
+
+# Mask of the first element of each run of equal elements of a sorted array
+def _run_starts(array):
+    keys, = _row_keys(array)
+    mask = numpy.empty(len(keys), dtype=bool)
+    mask[:1] = True
+    mask[1:] = keys[1:] != keys[:-1]
+    return mask
+
+
+# Remove the duplicates of a sorted array
+def _sorted_unique(array):
+    if len(array) == 0:
+        return array
+    return array[_run_starts(array)]
+
+
+# Merge many canonical arrays in one sorted array with duplicates
+def _merge_sorted(arrays):
+    if any(a.dtype.names for a in arrays):
+        arrays = _row_keys(*arrays)
+    result = numpy.concatenate([a for a in arrays if len(a)] or arrays[:1])
+    if result.ndim == 1:
+        result.sort(kind="stable")
+        return result
+    keys, = _row_keys(result)
+    return result[numpy.argsort(keys, kind="stable")]
+
+
+def _unique(elements):
+    if elements.ndim == 2 and elements.dtype.kind in "biuf":
+        return numpy.unique(elements, axis=0)
+    return numpy.unique(elements)
+
+
+# NOTE 21: The summary of a set is the amount of distinct elements, the first
+# and the last element of the canonical array, and a fingerprint that is the
+# sum modulo 2**64 of the hashes of the distinct elements, so it does not
+# depend on the order. It is kept while the canonical array is the same
+# object. The equality and the subset tests compare the summaries first and
+# only compare the arrays if they can not decide, by blocks that stop at the
+# first difference.
+
+
+_BLOCK = 65536
+
+_Summary = collections.namedtuple(
+    "_Summary", "source length minimum maximum fingerprint")
+
+
+def _summary(s):
+    elements = _canonical_elements(s)
+    summary = s._summary
+    if summary is None or summary.source is not elements:
+        bounded = elements.ndim == 1 and elements.dtype.kind in "biuf" \
+            and len(elements) and not numpy.isnan(elements[-1])
+        fingerprint = 0
+        for i in range(0, len(elements), _BLOCK):
+            with numpy.errstate(over="ignore"):
+                fingerprint += int(_hash64(elements[i:i + _BLOCK]).sum(
+                    dtype=numpy.uint64))
+        summary = _Summary(elements, len(elements),
+                           elements[0] if bounded else None,
+                           elements[-1] if bounded else None,
+                           fingerprint % 2**64)
+        s._summary = summary
+    return summary
+
+
+def _same_bounds(a, b):
+    if a.minimum is None or b.minimum is None:
+        return a.minimum is None and b.minimum is None or not a.length
+    return a.minimum == b.minimum and a.maximum == b.maximum
+
+
+# Get the elements of the set as a canonical array. The canonical form of
+# non canonical sets is computed once and saved until the elements change.
+def _canonical_elements(s):
+    elements = _get_elements(s)
+    if s.canonical:
+        return elements
+    if s._unique is None or s._unique[0] is not elements:
+        s._unique = (elements, _unique(elements))
+    return s._unique[1]
+
+
+# NOTE 6: The membership test use an index that is built the first time that
+# it is needed and is kept until the elements change. The index is a bitmap
+# if the elements are dense integers, a binary search over the array if the
+# set is canonical and a hash set in any other case.
+
+
+class _MembershipIndex:
+    def __init__(self, elements, canonical):
+        self.source = elements
+        # A canonical memory map is searched, the bitmap would read all pages
+        mapped = canonical and isinstance(elements, numpy.memmap)
+        if elements.dtype.kind in "iu" and elements.ndim == 1 \
+                and len(elements) and not mapped:
+            self.low = int(elements.min())
+            span = int(elements.max()) - self.low + 1
+            if span <= 8*len(elements) + 64:
+                self.kind = "bitmap"
+                self.bitmap = numpy.zeros(span, dtype=bool)
+                self.bitmap[elements.astype(numpy.intp) - self.low] = True
+                return
+        if canonical and elements.ndim == 1:
+            self.kind = "sorted"
+            self.sorted = elements
+            return
+        if elements.ndim == 2 and elements.dtype.kind in "biuf":
+            self.kind = "sorted"
+            self.sorted = elements if canonical else _unique(elements)
+            return
+        try:
+            if elements.ndim == 1:
+                self.hashes = frozenset(elements.tolist())
+            else:
+                self.hashes = frozenset(map(tuple, elements.tolist()))
+            self.kind = "hash"
+        except TypeError:
+            self.kind = "sorted"
+            self.sorted = numpy.unique(elements)
+
+    def __contains__(self, value):
+        if self.kind == "bitmap":
+            try:
+                position = int(value) - self.low
+            except (TypeError, ValueError, OverflowError):
+                return False
+            return position + self.low == value \
+                and 0 <= position < len(self.bitmap) \
+                and bool(self.bitmap[position])
+        elif self.kind == "hash":
+            try:
+                return value in self.hashes
+            except TypeError:
+                return False
+        if self.sorted.dtype.names:
+            try:
+                key = numpy.array([tuple(value)], dtype=self.sorted.dtype)
+                return key[0].item() == tuple(value) \
+                    and bool(_sorted_isin(key, self.sorted)[0])
+            except (TypeError, ValueError):
+                return False
+        if self.sorted.ndim == 2:
+            value = numpy.asarray(value)
+            return value.dtype.kind in "biuf" \
+                and value.shape == self.sorted.shape[1:] \
+                and bool(_sorted_isin(value[None], self.sorted)[0])
+        try:
+            position = numpy.searchsorted(self.sorted, value)
+            return position < len(self.sorted) \
+                and bool(self.sorted[position] == value)
+        except TypeError:
+            return False
+
+    def isin(self, values):
+        if self.kind == "bitmap" and values.dtype.kind in "iuf":
+            result = numpy.zeros(values.shape, dtype=bool)
+            with numpy.errstate(invalid="ignore"):
+                valid = (values >= self.low) \
+                    & (values < self.low + len(self.bitmap)) \
+                    & (numpy.floor(values) == values)
+            positions = values[valid].astype(numpy.intp) - self.low
+            result[valid] = self.bitmap[positions]
+            return result
+        elif self.kind == "hash" \
+                and (self.source.ndim > 1 or self.source.dtype.names):
+            rows = map(tuple, values.tolist())
+            return numpy.fromiter((r in self.hashes for r in rows),
+                                  dtype=bool, count=len(values))
+        elif self.kind == "hash":
+            self.sorted = numpy.unique(self.source)
+        try:
+            return _sorted_isin(values, self.sorted)
+        except TypeError:
+            return numpy.zeros(values.shape, dtype=bool)
+
+
+def _membership_index(s):
+    elements = _get_elements(s)
+    if s._index is None or s._index.source is not elements:
+        s._index = _MembershipIndex(elements, s.canonical)
+    return s._index
+
+
 class BaseSet:
-    @_ensure_elements
+    canonical = False
+    progression = None
+    symbolic = None
+    version = 0
+    _unique = None
+    _index = None
+    _dependents = None
+    _statistics = None
+    _summary = None
+
+    def __contains__(self, value):
+        if self.progression is not None:
+            return value in self.progression
+        if _is_infinite(self):
+            return bool(self.isin([value])[0])
+        return value in _membership_index(self)
+
+    def __len__(self):
+        if self.progression is not None:
+            return len(self.progression)
+        return len(_get_elements(self))
+
     def __eq__(self, other):
-        return numpy.array_equal(self.elements, other.elements)
+        if self.symbolic is not None and other.symbolic is not None:
+            return self.symbolic == other.symbolic
+        return self._equal_elements(other)
+
+    @_ensure_elements
+    def _equal_elements(self, other):
+        a, b = _summary(self), _summary(other)
+        if a.length != b.length or a.fingerprint != b.fingerprint \
+                or not _same_bounds(a, b):
+            return False
+        try:
+            left, right = _row_keys(_canonical_elements(self),
+                                    _canonical_elements(other))
+        except ValueError:
+            return False
+        return all(numpy.array_equal(left[i:i + _BLOCK], right[i:i + _BLOCK])
+                   for i in range(0, len(left), _BLOCK))
 
     def issubset(self, other):
-        return numpy.in1d(self.elements, other.elements)
+        if self.symbolic is not None and other.symbolic is not None:
+            result = self.symbolic.is_subset(other.symbolic)
+            if result is None:
+                raise TypeError("Can not decide the inclusion.")
+            return bool(result)
+        return self._subset_elements(other)
+
+    @_ensure_elements
+    def _subset_elements(self, other):
+        a, b = _summary(self), _summary(other)
+        if a.length > b.length:
+            return False
+        if a.length and a.minimum is not None and b.minimum is not None \
+                and (a.minimum < b.minimum or a.maximum > b.maximum):
+            return False
+        if a.length == b.length:
+            return self._equal_elements(other)
+        left, right = _canonical_elements(self), _canonical_elements(other)
+        return all(_sorted_isin(left[i:i + _BLOCK], right).all()
+                   for i in range(0, len(left), _BLOCK))
 
     def issuperset(self, other):
         return other.issubset(self)
 
+    def fingerprint(self):
+        """Return a hash of the elements that does not depend on the order.
+
+        It is computed once and kept until the elements change. See NOTE 21.
+        """
+        return _summary(self).fingerprint
+
+    def isin(self, values):
+        """Return a boolean mask with the values that are in the set."""
+        values = _element_array(values) if isinstance(values, (list, tuple)) \
+            else numpy.asarray(values)
+        if _is_infinite(self):
+            return numpy.fromiter(
+                (self.symbolic.contains(v) == sympy.true for v in values),
+                dtype=bool, count=len(values))
+        return _membership_index(self).isin(values)
+
     @_ensure_elements
     def isdisjoint(self, other):
-        diff = numpy.intersect1d(self.elements, other.elements)
-        if len(diff) == 0:
-            return True
-        else:
-            return False
+        return not _sorted_isin(_canonical_elements(self),
+                                _canonical_elements(other)).any()
+
+    def discretize(self, start=None, stop=None, num=50):
+        """Return a Domain with the elements of the set in a regular grid.
+
+        The bounds of the grid are the bounds of the set by default.
+        """
+        if start is None or stop is None:
+            if self.symbolic is None:
+                raise ValueError("The start and the stop are required.")
+            start = self.symbolic.inf if start is None else start
+            stop = self.symbolic.sup if stop is None else stop
+            if not (sympy.sympify(start).is_finite
+                    and sympy.sympify(stop).is_finite):
+                raise ValueError("The set is unbounded.")
+        grid = numpy.linspace(float(start), float(stop), num)
+        return Domain(grid[self.isin(grid)])
+
+    def statistics(self, precision=12):
+        """Return the statistics of the set. See NOTE 17.
+
+        They are built in one pass the first time and kept until the set
+        changes. A Set that is not computed is read by chunks.
+        """
+        statistics = self._statistics
+        if statistics is None or statistics.version != self.version \
+                or statistics.sketch.precision != precision:
+            statistics = Statistics(precision)
+            for chunk in _chunks(self):
+                statistics.update(chunk)
+            statistics.version = self.version
+            self._statistics = statistics
+        return statistics
+
+    def bloom_filter(self, error_rate=0.01, capacity=None):
+        """Return a BloomFilter of the elements. See NOTE 18.
+
+        The capacity is the amount of elements by default, a Set that is not
+        computed is read by chunks.
+        """
+        if capacity is None:
+            capacity = len(self.elements) if self.elements is not None \
+                else self.statistics().count
+        result = BloomFilter(capacity, error_rate)
+        for chunk in _chunks(self):
+            result.add(chunk)
+        return result
+
+    def canonicalize(self):
+        """Keep the elements sorted and without duplicates. See NOTE 5."""
+        self.elements = _canonical_elements(self)
+        self.canonical = True
+        return self
+
+    def save(self, path):
+        """Save the elements in a directory. See NOTE 10."""
+        elements = numpy.asarray(_get_elements(self))
+        canonical = self.canonical or _is_canonical(elements)
+        os.makedirs(path, exist_ok=True)
+        numpy.save(os.path.join(path, "elements.npy"), elements,
+                   allow_pickle=False)
+        metadata = {"type": type(self).__name__,
+                    "dtype": elements.dtype.str,
+                    "shape": list(elements.shape),
+                    "canonical": bool(canonical),
+                    "varnames": list(getattr(self, "varnames", None) or [])}
+        with open(os.path.join(path, "metadata.json"), "w") as file:
+            json.dump(metadata, file)
 
     def __le__(self, other):
-        return self < other or self == other
+        return self.issubset(other)
+
+    def __lt__(self, other):
+        return self.issubset(other) and not self == other
 
     def __ge__(self, other):
-        return self > other or self == other
+        return other.issubset(self)
+
+    def __gt__(self, other):
+        return other < self
 
-    @_ensure_elements
     def union(self, other):
-        result = numpy.union1d(self.elements, other.elements)
-        return Set(x for x in result)
+        return _operation("union", self, other)
 
-    @_ensure_elements
     def intersection(self, other):
-        result = numpy.intersect1d(self.elements, other.elements)
-        return Set(x for x in result)
+        return _operation("intersection", self, other)
 
-    @_ensure_elements
     def difference(self, other):
-        result = numpy.setdiff1d(self.elements, other.elements)
-        return Set(x for x in result)
+        return _operation("difference", self, other)
 
-    @_ensure_elements
     def symmetric_difference(self, other):
-        result = numpy.setxor1d(self.elements, other.elements)
-        return Set(x for x in result)
+        return _operation("symmetric_difference", self, other)
 
     @_ensure_elements
     def __mul__(self, other):
         return Product(self, other)
 
     def __pow__(self, value):
-        if self.elements is None:
-            iter(self)
-        arrays = [self.elements]*value
-        product = list(zip(*arrays))
-        return Domain(product)
+        elements = _get_elements(self)
+        return Domain(numpy.column_stack([elements]*value))
+
+    def cartesian(self, *others):
+        """Return the lazy Cartesian product with other sets."""
+        return CartesianProduct(self, *others)
+
+    def cartesian_power(self, value):
+        """Return the lazy Cartesian product of "value" copies of the set."""
+        return CartesianProduct(*[self]*value)
 
-    @_ensure_elements
     def __add__(self, other):
         return Sum(self, other)
 
     __xor__ = symmetric_difference
     __sub__ = difference
-    __lt__ = issubset
     __or__ = union
     __and__ = intersection
 
@@ -294,32 +1721,784 @@ class Product(BaseSet):
     def __iter__(self):
         return iter(zip(*self.elements))
 
+    def __contains__(self, value):
+        return value in iter(self)
+
+    def __len__(self):
+        return min(len(s) for s in self.elements)
+
+
+# NOTE 11: A CartesianProduct never builds its tuples. The element k is found
+# from the index k written in a mixed radix, where the radix of each digit is
+# the size of a factor and the last factor is the fastest digit, as in
+# itertools.product. A block of consecutive indices gives a column by factor,
+# so the constraints of a Set over the product are evaluated block by block.
+#
+#     A = {a0, a1, a2}, B = {b0, b1}:    k = 3  ──>  (1, 1)  ──>  (a1, b1)
+
+
+class CartesianProduct(BaseSet):
+    """The set of all the tuples with an element of each set. See NOTE 11."""
+    def __init__(self, *sets):
+        self.sets = []
+        for s in sets:
+            if isinstance(s, CartesianProduct):
+                self.sets.extend(s.sets)
+            else:
+                self.sets.append(s)
+        self.elements = None
+        self._factors = None
+
+    @property
+    def factors(self):
+        """The elements of each set, as arrays."""
+        if self._factors is None:
+            self._factors = [numpy.asarray(_get_elements(s))
+                             for s in self.sets]
+        return self._factors
+
+    @property
+    def shape(self):
+        return tuple(len(f) for f in self.factors)
+
+    def __len__(self):
+        return math.prod(self.shape)
+
+    def columns(self, indices):
+        """Return the columns of the elements at the given indices."""
+        digits = numpy.unravel_index(indices, self.shape)
+        return [f[d] for f, d in zip(self.factors, digits)]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            index = numpy.arange(*index.indices(len(self)))
+        elif not isinstance(index, (list, numpy.ndarray)):
+            length = len(self)
+            if not -length <= index < length:
+                raise IndexError("The index is out of range.")
+            return tuple(c.item() for c in self.columns(index % length))
+        return _stack_columns(self.columns(numpy.asarray(index)))
+
+    def column_blocks(self, size=65536):
+        """Yield the columns of blocks of "size" consecutive elements."""
+        length = len(self)
+        for start in range(0, length, size):
+            yield self.columns(numpy.arange(start, min(start + size, length)))
+
+    def iter_chunks(self, size=65536):
+        """Yield the elements in arrays with a row by element."""
+        for columns in self.column_blocks(size):
+            yield _stack_columns(columns)
+
+    def to_array(self):
+        """Return all the elements in an array with a row by element."""
+        return self[:]
+
+    def __iter__(self):
+        return _ProductIterator(self)
+
+    def __contains__(self, value):
+        try:
+            return len(value) == len(self.sets) \
+                and all(v in s for v, s in zip(value, self.sets))
+        except TypeError:
+            return False
+
+
+# NOTE 14: A Set over a CartesianProduct looks for a conjunct of its
+# constraint that compares expressions of two different factors, like
+# "x == y" or "2*x < y + 1". The expression of each side is evaluated once
+# by factor, the keys of one side are sorted and the keys of the other side
+# are searched, so only the pairs that satisfy the conjunct are built. If the
+# keys of an equality can not be computed with arrays, like "x.key == y.key"
+# over objects, they are computed in python, one by element, and the join is
+# a hash join: the elements of one side are grouped by key in a dict that is
+# probed with the keys of the other side. The equalities are preferred to
+# the ranges. The whole constraint is evaluated after, only over the joined
+# rows, and the rows are kept in the order of the product.
+
+
+# The variables used by an expression tree
+def _variables(node):
+    if node.op == "var":
+        return {node.args[0]}
+    return set().union(*[_variables(a) for a in node.args
+                         if isinstance(a, _Node)])
+
+
+# Get the conjunct of a join. Return the comparison and the two sides with
+# the factor of each one, or None.
+def _join_conjunct(trace):
+    joins = []
+    for node in trace.conjuncts + (trace.value,):
+        if node.op != "compare" \
+                or node.args[0] not in ("==", "<", "<=", ">", ">="):
+            continue
+        left, right = _variables(node.args[1]), _variables(node.args[2])
+        if len(left) == 1 and len(right) == 1 and left != right:
+            joins.append((node.args[0] != "==", node.args[0],
+                          left.pop(), node.args[1], right.pop(),
+                          node.args[2]))
+    return min(joins, key=lambda j: j[0])[1:] if joins else None
+
+
+# Expand ranges of positions of a sorted array: row i of the left side
+# matches the positions start[i]:stop[i] of the right side.
+def _expand_ranges(start, stop):
+    counts = stop - start
+    left = numpy.repeat(numpy.arange(len(start)), counts)
+    offsets = numpy.arange(counts.sum()) \
+        - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    return left, numpy.repeat(start, counts) + offsets
+
+
+# Indices of the pairs of keys that satisfy "left comparison right"
+def _join_indices(comparison, left, right):
+    left_valid = numpy.flatnonzero(~numpy.isnan(left)) \
+        if left.dtype.kind == "f" else numpy.arange(len(left))
+    right_valid = numpy.flatnonzero(~numpy.isnan(right)) \
+        if right.dtype.kind == "f" else numpy.arange(len(right))
+    order = right_valid[numpy.argsort(right[right_valid], kind="stable")]
+    keys, values = right[order], left[left_valid]
+    end = numpy.full(len(values), len(keys))
+    zero = numpy.zeros(len(values), dtype=numpy.intp)
+    if comparison == "==":
+        start = numpy.searchsorted(keys, values, "left")
+        stop = numpy.searchsorted(keys, values, "right")
+    elif comparison in ("<", "<="):
+        start = numpy.searchsorted(keys, values,
+                                   "right" if comparison == "<" else "left")
+        stop = end
+    else:
+        start = zero
+        stop = numpy.searchsorted(keys, values,
+                                  "left" if comparison == ">" else "right")
+    i, j = _expand_ranges(start, stop)
+    return left_valid[i], order[j]
+
+
+def _join_keys(node, factors, namespace, size):
+    value = numpy.asarray(_evaluate(node, factors, namespace, {}))
+    if value.dtype.kind not in "biuf":
+        raise _Unsupported("The keys of the join are not numeric.")
+    return numpy.broadcast_to(value, (size,))
+
+
+# Evaluate an expression tree with python values as variables
+def _python_value(node, values, namespace):
+    op, args = node
+    if op == "var":
+        return values[args[0]]
+    elif op == "const":
+        return args[0]
+    elif op == "global":
+        return _load_global(namespace, args[0])
+    elif op == "attr":
+        return getattr(_python_value(args[0], values, namespace), args[1])
+    elif op == "tuple":
+        return tuple(_python_value(a, values, namespace) for a in args)
+    operands = [_python_value(a, values, namespace)
+                for a in args[op != "call":]]
+    if op == "call":
+        return operands[0](*operands[1:])
+    elif op == "binary":
+        return _BINARY_OPERATORS[args[0]](*operands)
+    elif op == "compare":
+        return _COMPARE_OPERATORS[args[0]](*operands)
+    elif op == "unary":
+        return not operands[0] if args[0] == "not" \
+            else _UNARY_OPERATORS[args[0]](*operands)
+    raise _Unsupported("Unknown node %r." % op)
+
+
+# Indices of the pairs of elements of the factors i and j whose keys are
+# equal, with a dict of the positions of the keys of the factor j
+def _hash_join(factors, i, left, j, right, namespace):
+    positions = {}
+    for k, element in enumerate(factors[j].tolist()):
+        key = _python_value(right, {j: element}, namespace)
+        positions.setdefault(key, []).append(k)
+    pairs = [(k, position)
+             for k, element in enumerate(factors[i].tolist())
+             for position in positions.get(
+                 _python_value(left, {i: element}, namespace), ())]
+    pairs = numpy.array(pairs, dtype=numpy.intp).reshape(-1, 2)
+    return pairs[:, 0], pairs[:, 1]
+
+
+def join_elements(member, constraint, product):
+    """Evaluate a Set over a CartesianProduct with a join. See NOTE 14.
+
+    Return the array of the elements or None if the constraint has not a
+    comparison between two factors or it can not be vectorized.
+    """
+    trace = _trace(constraint)
+    if trace is None or constraint.__code__.co_argcount != len(product.sets):
+        return None
+    join = _join_conjunct(trace)
+    if join is None:
+        return None
+    comparison, i, left, j, right = join
+    factors, shape = product.factors, product.shape
+    namespace = constraint.__globals__
+    try:
+        with numpy.errstate(all="raise", under="ignore"):
+            keys = (_join_keys(left, factors, namespace, shape[i]),
+                    _join_keys(right, factors, namespace, shape[j]))
+    except Exception:
+        if comparison != "==":
+            return None
+        try:
+            left, right = _hash_join(factors, i, left, j, right, namespace)
+        except Exception:
+            return None
+    else:
+        left, right = _join_indices(comparison, *keys)
+    rest = [k for k in range(len(factors)) if k not in (i, j)]
+    digits = numpy.unravel_index(
+        numpy.arange(len(left)*math.prod(shape[k] for k in rest)),
+        (len(left),) + tuple(shape[k] for k in rest))
+    indices = [None]*len(factors)
+    indices[i], indices[j] = left[digits[0]], right[digits[0]]
+    for k, d in zip(rest, digits[1:]):
+        indices[k] = d
+    if len(digits[0]):
+        order = numpy.argsort(numpy.ravel_multi_index(indices, shape))
+        indices = [index[order] for index in indices]
+    columns = [f[index] for f, index in zip(factors, indices)]
+    if not len(columns[0]):
+        return numpy.array([])
+    try:
+        return _vectorized_call(member, [constraint], columns)[1]
+    except Exception:
+        rows = zip(*[c.tolist() for c in columns])
+        return _element_array(member(*r) for r in rows if constraint(*r))
+
+
+# NOTE 19: A Sum is flat, the sums of sums are joined in one Sum like the
+# products, so its elements are the concatenation of the elements of all its
+# sets in one step. A Sum with "unique" is the sorted union of its sets
+# without duplicates, made with a k-way merge by blocks: the blocks of the
+# sorted sets are cut at the smallest of their last values, so the values of
+# the next blocks are greater and each cut is merged alone.
+
+
+# Yield sorted blocks without duplicates of the union of sorted arrays
+def _merge_blocks(arrays, size):
+    arrays = [a for a in arrays if len(a)]
+    positions = [0]*len(arrays)
+    while arrays:
+        blocks = [a[p:p + size] for a, p in zip(arrays, positions)]
+        threshold = min(b[-1] for b in blocks)
+        cut = [b[:numpy.searchsorted(b, threshold, side="right")]
+               for b in blocks]
+        yield _sorted_unique(_merge_sorted(cut))
+        positions = [p + len(c) for p, c in zip(positions, cut)]
+        alive = [i for i, a in enumerate(arrays) if positions[i] < len(a)]
+        arrays = [arrays[i] for i in alive]
+        positions = [positions[i] for i in alive]
+
 
 class Sum(BaseSet):
-    def __init__(self, left, right):
-        self.left = left
-        self.right = right
+    """The concatenation of sets. See NOTE 19.
+
+    If "unique" is true, the elements are sorted and without duplicates.
+    """
+    def __init__(self, *sets, unique=False):
+        self.sets = []
+        for s in sets:
+            if isinstance(s, Sum) and s.unique == unique \
+                    and s.elements is None:
+                self.sets.extend(s.sets)
+            else:
+                self.sets.append(s)
+        self.unique = unique
+        self.canonical = unique
+        self.elements = None
+
+    @property
+    def left(self):
+        return self.sets[0]
+
+    @property
+    def right(self):
+        return self.sets[1] if len(self.sets) == 2 else Sum(*self.sets[1:])
+
+    def iter_chunks(self, size=65536):
+        """Yield the elements in arrays with "size" elements at most."""
+        if self.elements is not None:
+            arrays = [self.elements]
+        elif self.unique:
+            arrays = [_canonical_elements(s) for s in self.sets]
+            if all(a.ndim == 1 for a in arrays):
+                yield from _merge_blocks(arrays, size)
+                return
+            arrays = [_union_elements(self.sets)]
+        else:
+            arrays = [_get_elements(s) for s in self.sets]
+        for a in arrays:
+            for start in range(0, len(a), size):
+                yield a[start:start + size]
 
     def __iter__(self):
-        return itertools.chain(self.left, self.right)
+        if self.elements is None:
+            if any(_is_infinite(s) for s in self.sets):
+                return itertools.chain(*self.sets)
+            if self.unique:
+                self.elements = _union_elements(self.sets)
+            else:
+                self.elements = _concatenate(
+                    [_get_elements(s) for s in self.sets])
+        return _DomainIterator(self.elements, self)
+
+    def __contains__(self, value):
+        return any(value in s for s in self.sets)
+
+    def __len__(self):
+        if self.unique:
+            return len(_get_elements(self))
+        return sum(len(s) for s in self.sets)
+
+# NOTE 4: The set algebra operators are lazy. They build a graph of Operation
+# nodes and nothing is computed until the elements are needed. Then the
+# planner fuse the nested operations of the same kind in one n-ary operation,
+# put the smallest operand first in the intersections and compute the result
+# as a single array, without create intermediate Set objects.
+#
+#     (A | B) | C  ──>  union(A, B, C)
+#     (A - B) - C  ──>  difference(A, B, C)  ──>  A - (B ∪ C)
+#     A & B & C    ──>  intersection(C, A, B)    if C is the smallest
 
-class _ConstrainedSet:
-    def __init__(self, elements, constraint):
-        self.elements = elements
-        self.constraint = constraint
 
-    def __next__(self):
-        return next(self.elements)
+_ASSOCIATIVE = ("union", "intersection", "symmetric_difference")
+
+
+def _get_elements(s):
+    if s.elements is None:
+        if isinstance(s, CartesianProduct):
+            s.elements = s.to_array()
+        elif isinstance(s, Set):
+            s._compute_elements()
+        else:
+            iter(s)
+    return s.elements
+
+
+# Upper bound of the amount of elements of a set. Do not compute anything.
+def _estimate_size(s):
+    if s.elements is not None:
+        return len(s.elements)
+    if s._statistics is not None and s._statistics.version == s.version:
+        return s._statistics.count
+    if isinstance(s, Operation):
+        sizes = [_estimate_size(o) for o in s.operands]
+        if s.name == "intersection":
+            return min(sizes)
+        elif s.name == "difference":
+            return sizes[0]
+        return sum(sizes)
+    if isinstance(s, Set):
+        return operator.length_hint(s.domain, sys.maxsize)
+    return sys.maxsize
+
+
+def estimate_size(s, precision=12):
+    """Estimate the amount of distinct elements of a set. See NOTE 17.
+
+    The operations are not computed, their size is estimated with the
+    statistics of their operands.
+    """
+    if not isinstance(s, Operation) or s.elements is not None:
+        return float(s.statistics(precision).distinct())
+    return _estimate_operation(s, precision)[0]
+
+
+# Estimate the size of an operation and get statistics that approximate it
+def _estimate_operation(s, precision):
+    if not isinstance(s, Operation) or s.elements is not None:
+        statistics = s.statistics(precision)
+        return statistics.distinct(), statistics
+    results = [_estimate_operation(o, precision) for o in s.operands]
+    size, statistics = results[0]
+    for other_size, other in results[1:]:
+        if s.name == "union":
+            merged = Statistics(precision)
+            merged.sketch = statistics.sketch.merge(other.sketch)
+            merged.count = statistics.count + other.count
+            if None not in (statistics.minimum, other.minimum):
+                merged.minimum = min(statistics.minimum, other.minimum)
+                merged.maximum = max(statistics.maximum, other.maximum)
+            size = max(merged.distinct(), size, other_size)
+            statistics = merged
+        elif s.name == "intersection":
+            estimate = statistics.intersection(other)
+            if other_size < size:
+                statistics = other  # the smaller operand approximates it
+            size = min(estimate, size, other_size)
+        elif s.name == "difference":
+            size = min(max(size - statistics.intersection(other), 0.0), size)
+        else:
+            size = max(statistics.union(other)
+                       - statistics.intersection(other), 0.0)
+            merged = Statistics(precision)
+            merged.sketch = statistics.sketch.merge(other.sketch)
+            merged.count = statistics.count + other.count
+            statistics = merged
+    return float(size), statistics
+
+
+def _union_elements(operands):
+    return _sorted_unique(_merge_sorted(
+        [_canonical_elements(o) for o in operands]))
+
+
+# The infinite sets are filters, they are never materialized
+def _isin(values, s):
+    if _is_infinite(s):
+        return s.isin(values)
+    return _sorted_isin(values, _canonical_elements(s))
+
+
+def _intersection_elements(operands):
+    operands = sorted(operands, key=lambda o: (_is_infinite(o),
+                                               _estimate_size(o)))
+    result = _canonical_elements(operands[0])
+    for o in operands[1:]:
+        if len(result) == 0:
+            break  # the remaining operands are never computed
+        result = result[_isin(result, o)]
+    return result
+
+
+def _difference_elements(operands):
+    result = _canonical_elements(operands[0])
+    for o in operands[1:]:
+        if len(result) == 0:
+            break
+        result = result[~_isin(result, o)]
+    return result
+
+
+# An element belongs to the symmetric difference of many sets
+# if it is in an odd amount of them.
+def _symmetric_difference_elements(operands):
+    merged = _merge_sorted([_canonical_elements(o) for o in operands])
+    if len(merged) == 0:
+        return merged
+    starts = numpy.flatnonzero(_run_starts(merged))
+    counts = numpy.diff(numpy.append(starts, len(merged)))
+    return merged[starts[counts % 2 == 1]]
+
+
+_PLANS = {"union": _union_elements,
+          "intersection": _intersection_elements,
+          "difference": _difference_elements,
+          "symmetric_difference": _symmetric_difference_elements}
+
+
+# Combine the progressions of the operands. See NOTE 7
+def _operation_progression(name, operands):
+    progressions = [o.progression for o in operands]
+    if None in progressions:
+        return None
+    result = progressions[0]
+    for p in progressions[1:]:
+        result = getattr(result, name)(p)
+        if result is None:
+            return None
+    return result
+
+
+_SYMPY_OPERATIONS = {"union": sympy.Union,
+                     "intersection": sympy.Intersection,
+                     "symmetric_difference": sympy.SymmetricDifference}
+
+
+# Combine the SymPy sets of the operands. See NOTE 8
+def _operation_symbolic(name, operands):
+    symbolic = [o.symbolic for o in operands]
+    if None in symbolic:
+        return None
+    if name == "difference":
+        return sympy.Complement(symbolic[0], sympy.Union(*symbolic[1:]))
+    return functools.reduce(_SYMPY_OPERATIONS[name], symbolic)
+
+
+class Operation(BaseSet):
+    """A lazy node of the set algebra. See NOTE 4."""
+    canonical = True
+
+    def __init__(self, name, *operands):
+        self.name = name
+        self.operands = []
+        for i, o in enumerate(operands):
+            fusible = isinstance(o, Operation) and o.name == name \
+                and o.elements is None \
+                and (name in _ASSOCIATIVE or i == 0)
+            if fusible:
+                self.operands.extend(o.operands)
+            else:
+                self.operands.append(o)
+        self.progression = _operation_progression(name, self.operands)
+        self.symbolic = _operation_symbolic(name, self.operands)
+        self.elements = None
+        for o in self.operands:
+            _depend(o, self)
+
+    # Update the elements after a change of an operand. See NOTE 16.
+    def _source_changed(self, source, added, removed):
+        self.version += 1
+        if self.elements is None:
+            _notify(self, None, None)
+            return
+        if added is None:
+            self.elements = None
+            _notify(self, None, None)
+            return
+        values = _unique(numpy.concatenate([added, removed]))
+        if self.name == "union":
+            mask = _any_isin(values, self.operands)
+        elif self.name == "intersection":
+            mask = ~_any_isin(values, self.operands, negate=True)
+        elif self.name == "difference":
+            mask = _isin(values, self.operands[0]) \
+                & ~_any_isin(values, self.operands[1:])
+        else:
+            mask = sum(_isin(values, o).astype(int)
+                       for o in self.operands) % 2 == 1
+        present = _sorted_isin(values, self.elements)
+        kept = self.elements[~_sorted_isin(self.elements, values)]
+        self.elements = _merge_sorted([kept, values[mask]])
+        _notify(self, values[mask & ~present], values[~mask & present])
 
     def __iter__(self):
-        return self
+        if self.elements is None:
+            if _is_infinite(self):
+                raise TypeError("The set is infinite, use discretize().")
+            elif self.symbolic is not None:
+                self.elements = numpy.array(
+                    sorted(_python_number(v) for v in self.symbolic))
+            elif self.progression is not None:
+                self.elements = numpy.sort(self.progression.to_array())
+            else:
+                self.elements = _PLANS[self.name](self.operands)
+        return _DomainIterator(self.elements, self)
+
+
+# The iterator of a Set. The elements of the source Set are computed the
+# first time that they are needed, so a Set over it can push its constraint
+# down before. See NOTE 15.
+class _ConstrainedSet(_ArrayIterator):
+    def __init__(self, elements, constraint, source=None):
+        self._elements = elements
+        self.constraint = constraint
+        self.source = source
+
+    @property
+    def array(self):
+        if self._elements is None:
+            self._elements = self.source._compute_elements()
+        return self._elements
+
+
+# NOTE 15: A Set over other Set that is not computed yet is evaluated over the
+# domain of the inner Set. The variables of the outer Set are replaced by the
+# member of the inner Set in the expression trees, so the conjuncts of both
+# constraints test the rows of the base domain, and the inner elements that
+# the outer constraint rejects are never computed. The base domain is read in
+# blocks and each conjunct only tests the rows that passed the previous ones.
+# The time by row and the fraction of rows that each conjunct rejects are
+# measured, and the conjuncts of the next blocks are sorted by the time
+# needed to reject a row, so the cheap and selective conjuncts go first.
+#
+#     A = Set(x*x for x in D if x > 0)        x > 0
+#     B = Set(y + 1 for y in A if y < 9)  ──> x*x < 9   ──> x*x + 1
+#
+# Any error in the pushed plan falls back to compute the inner Set first.
+
+
+# Replace the variables of an expression tree by other trees
+def _substitute(node, values, cache):
+    if id(node) in cache:
+        return cache[id(node)]
+    if node.op == "var":
+        result = values[node.args[0]]
+    else:
+        result = _Node(node.op, tuple(
+            _substitute(a, values, cache) if isinstance(a, _Node) else a
+            for a in node.args))
+    cache[id(node)] = result
+    return result
+
+
+class _Conjunct:
+    def __init__(self, node):
+        self.node = node
+        self.rows = 0
+        self.rejected = 0
+        self.seconds = 0.0
+
+    # Expected time to reject a row, the first blocks keep the given order
+    def rank(self):
+        if not self.rows:
+            return 0.0
+        return self.seconds / max(self.rejected, 0.5)
+
+
+# The plan of a Set over the base domain: the domain, the amount of
+# variables, the conjuncts, the member and the namespace. None if the Set can
+# not be pushed down.
+def _pushdown_plan(s):
+    member = _trace(s.member)
+    constraint = _trace(s.constraint)
+    if member is None or member.conjuncts or constraint is None \
+            or s.member.__globals__ is not s.constraint.__globals__:
+        return None
+    conjuncts = [c for c in constraint.conjuncts + (constraint.value,)
+                 if not (c.op == "const" and c.args[0] is True)]
+    namespace = s.member.__globals__
+    inner = s.domain.source if isinstance(s.domain, _ConstrainedSet) \
+        else None
+    if inner is None or s.domain._elements is not None \
+            or inner.elements is not None:
+        return s.domain, len(s.varnames), conjuncts, member.value, namespace
+    if inner.canonical or inner.progression is not None \
+            or inner.symbolic is not None:
+        return None
+    plan = _pushdown_plan(inner)
+    if plan is None or plan[4] is not namespace:
+        return None
+    domain, count, inner_conjuncts, value, _ = plan
+    if len(s.varnames) == 1:
+        values = [value]
+    elif value.op == "tuple" and len(value.args) == len(s.varnames):
+        values = list(value.args)
+    else:
+        return None
+    cache = {}
+    conjuncts = [_substitute(c, values, cache) for c in conjuncts]
+    return (domain, count, inner_conjuncts + conjuncts,
+            _substitute(member.value, values, cache), namespace)
+
+
+def pushdown_elements(s, size=65536):
+    """Evaluate a Set over other Set with the constraints pushed down.
+
+    Return the array of the elements or None if the inner Set is computed
+    or the plan can not be vectorized. See NOTE 15.
+    """
+    if not isinstance(s.domain, _ConstrainedSet) \
+            or s.domain._elements is not None:
+        return None
+    plan = _pushdown_plan(s)
+    if plan is None:
+        return None
+    domain, count, nodes, member, namespace = plan
+    conjuncts = [_Conjunct(n) for n in nodes]
+    if _iterator_sequence(domain) is None \
+            and _zip_sequences(domain, count) is None:
+        return None  # the domain would be consumed before a fall back
+    results = []
+    try:
+        with numpy.errstate(all="raise", under="ignore"):
+            for columns in _domain_blocks(domain, count, size):
+                for c in sorted(conjuncts, key=_Conjunct.rank):
+                    if not len(columns[0]):
+                        break
+                    start = time.perf_counter()
+                    mask = _as_mask(_evaluate(c.node, columns, namespace, {}),
+                                    len(columns[0]))
+                    c.seconds += time.perf_counter() - start
+                    c.rows += len(mask)
+                    c.rejected += len(mask) - numpy.count_nonzero(mask)
+                    columns = [column[mask] for column in columns]
+                if len(columns[0]):
+                    value = _evaluate(member, columns, namespace, {})
+                    results.append(_as_elements(value, len(columns[0])))
+    except Exception:
+        return None
+    return numpy.concatenate(results) if results else numpy.array([])
+
+
+# NOTE 12: A Set with "workers" evaluates the blocks of its domain in a pool.
+# The members that the vectorized engine runs use threads, because NumPy
+# releases the GIL, and the others use processes. The functions are sent to
+# the processes as marshal data of their code with the globals and the
+# closure that the code use, the modules are sent by name and imported again.
+# The results of the blocks are joined in the order of the domain.
+
+
+# Serializable data to rebuild a generated function in other process
+def _portable_function(function):
+    code = function.__code__
+    names = {}
+    for name in code.co_names:
+        if name in function.__globals__:
+            value = function.__globals__[name]
+            if isinstance(value, types.ModuleType):
+                value = _ModuleReference(value.__name__)
+            names[name] = value
+    closure = [c.cell_contents for c in function.__closure__ or ()]
+    closure = [_FunctionReference(_portable_function(v))
+               if isinstance(v, types.FunctionType) else v for v in closure]
+    return marshal.dumps(code), function.__name__, names, closure
+
+
+_ModuleReference = collections.namedtuple("_ModuleReference", "name")
+
+# A function of a closure, as the generator of the functions without source
+_FunctionReference = collections.namedtuple("_FunctionReference", "portable")
+
+
+_portable_functions = {}
+
+
+def _rebuild_function(portable):
+    code, name, names, closure = portable
+    # The values of a closure differ between the sets of the same code
+    key = (code, name) if not closure else None
+    if key not in _portable_functions:
+        namespace = {"__builtins__": builtins}
+        for k, v in names.items():
+            namespace[k] = importlib.import_module(v.name) \
+                if isinstance(v, _ModuleReference) else v
+        cells = tuple(types.CellType(_rebuild_function(v.portable)
+                                     if isinstance(v, _FunctionReference)
+                                     else v) for v in closure)
+        function = types.FunctionType(
+            marshal.loads(code), namespace, name, None, cells or None)
+        if key is None:
+            return function
+        _portable_functions[key] = function
+    return _portable_functions[key]
+
+
+# Evaluate a block of the domain in a worker process
+def _evaluate_portable(member, constraint, columns):
+    member = _rebuild_function(member)
+    constraint = _rebuild_function(constraint)
+    return _element_array(member(*r) for r in zip(*columns) if constraint(*r))
+
+
+# The cache of the calls of a Set: None or False for no cache, True for a
+# cache of the default size or the maximum size of the cache
+def _call_cache(memoize):
+    if memoize is None or memoize is False:
+        return None
+    if memoize is True:
+        return CallCache()
+    if not isinstance(memoize, int) or memoize <= 0:
+        raise ValueError("memoize must be a bool or a positive integer.")
+    return CallCache(memoize)
 
 
 class Set(BaseSet):
-    def __init__(self, expression):
+    def __init__(self, expression, vectorize=True, canonical=False,
+                 workers=None, chunk_size=65536, executor=None, dtype=None,
+                 memoize=None):
         self.expression = expression
         self.member = get_member(expression)
-        self.varnames = expression.gi_code.co_varnames[1:]
+        self.varnames = _expression(expression).varnames
         self.domain = expression.gi_frame.f_locals['.0']
         self.constraint = get_constraints(expression)
         _function = generator_to_function(expression)
@@ -333,35 +2512,1252 @@ class Set(BaseSet):
             self.function = constrained_function
         else:
             self.function = _function
+        self.vectorize = vectorize
+        self.canonical = canonical
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.executor = executor
+        self.dtype = dtype
+        self.call_cache = _call_cache(memoize)
+        self.engine = None
         self.elements = None
+        self._stale = False
+        self._rows = self._values = None
+        if isinstance(self.domain, _DomainIterator):
+            _depend(self.domain.domain, self)
+        elif isinstance(self.domain, _ConstrainedSet):
+            _depend(self.domain.source, self)
+        self._analysis = None
+
+    # The progression and the SymPy set are found the first time that they
+    # are used, so they take the values of the free variables at that time,
+    # like the elements.
+    def _analyse(self):
+        if self._analysis is None:
+            progression = symbolic = None
+            if isinstance(self.domain, _SymbolicIterator):
+                symbolic = symbolic_set(self.member, self.constraint,
+                                        self.domain.universe.symbolic)
+            elif self.vectorize:
+                progression = range_progression(
+                    self.member, self.constraint, self.domain)
+            self._analysis = [progression, symbolic]
+        return self._analysis
+
+    @property
+    def progression(self):
+        return self._analyse()[0]
+
+    @progression.setter
+    def progression(self, value):
+        self._analyse()[0] = value
+
+    @property
+    def symbolic(self):
+        return self._analyse()[1]
 
     def __call__(self, *element):
+        if self.call_cache is not None:
+            return self.call_cache.call(self.function, element)
         return self.function(*element)
 
+    def __contains__(self, value):
+        if isinstance(self.domain, _SymbolicIterator):
+            return bool(self.isin([value])[0])
+        return super().__contains__(value)
+
+    def __len__(self):
+        if _is_infinite(self):
+            raise TypeError("The set is infinite.")
+        return super().__len__()
+
+    # The membership of a Set over a number set is decided by SymPy. If it
+    # can not, the constraint is called with the values of the variable that
+    # the member maps to the value.
+    def isin(self, values):
+        if not isinstance(self.domain, _SymbolicIterator):
+            return super().isin(values)
+        values = numpy.asarray(values)
+        mask = numpy.zeros(len(values), dtype=bool)
+        pending = numpy.ones(len(values), dtype=bool)
+        if self.symbolic is not None:
+            for i, v in enumerate(values):
+                result = self.symbolic.contains(v)
+                if result in (sympy.true, sympy.false):
+                    mask[i] = result == sympy.true
+                    pending[i] = False
+        if not pending.any():
+            return mask
+        trace = _trace(self.member)
+        if trace is not None and trace.value.op == "var" \
+                and not trace.conjuncts:
+            candidates = values[pending]
+            applied = self.apply(candidates, masked=True)
+            mask[pending] = self.domain.universe.isin(candidates) \
+                & ~applied.mask
+            return mask
+        for i in numpy.flatnonzero(pending):
+            variables = _preimage(self.member, values[i])
+            if variables is None:
+                raise TypeError("Can not decide the membership.")
+            variables = [v for v, inside in zip(
+                variables, self.domain.universe.isin(variables)) if inside]
+            mask[i] = any(self.constraint(v) for v in variables)
+        return mask
+
+    # Return the mask of the accepted rows and the values of that rows
+    def _call_columns(self, columns, constraints):
+        try:
+            return _vectorized_call(self.member, constraints, columns)
+        except Exception:
+            mask = numpy.fromiter(
+                (all(c(*row) for c in constraints) for row in zip(*columns)),
+                dtype=bool, count=len(columns[0]))
+            selected = zip(*[c[mask] for c in columns])
+            return mask, _element_array(self.member(*row) for row in selected)
+
+    def apply(self, *arrays, masked=False):
+        """Call the function of the set with arrays, one per variable.
+
+        The rejected elements are filled with NaN or masked if "masked" is
+        true. Do not raise errors for that elements.
+        """
+        columns = [numpy.asarray(a) for a in arrays]
+        if len(columns) == 1 and len(self.varnames) > 1:
+            columns = list(columns[0].T)
+        constraints = [self.constraint]
+        if isinstance(self.domain, _ConstrainedSet):
+            constraints.insert(0, self.domain.constraint)
+        mask, values = self._call_columns(columns, constraints)
+        return _fill_rejected(values, mask, masked)
+
+    # The rows of the domain that give each element and the elements
+    def _evaluate_rows(self, rows):
+        if not len(rows):
+            return rows, numpy.array([])
+        columns = _block_columns(rows, len(self.varnames))
+        mask, values = self._call_columns(columns, [self.constraint])
+        return rows[mask], values
+
+    # Update the elements after a change of the domain. See NOTE 16.
+    def _source_changed(self, source, added, removed):
+        self.version += 1
+        if self.call_cache is not None:
+            self.call_cache.clear()  # the constraint of the source changed
+        self.domain = iter(source)
+        self.progression = None
+        self._stale = True
+        if self.elements is None:
+            _notify(self, None, None)  # a Set over it could be pushed down
+            return
+        if added is None or not (isinstance(source, Domain)
+                                 or source.canonical):
+            self.elements = self._rows = self._values = None
+            _notify(self, None, None)
+            return
+        old = _canonical_elements(self)
+        if self._rows is None:
+            self._rows, self._values = self._evaluate_rows(
+                numpy.asarray(source.elements))
+            changed = old
+        else:
+            lost = _sorted_isin(self._rows, removed) if len(removed) \
+                else numpy.zeros(len(self._rows), dtype=bool)
+            rows, values = self._evaluate_rows(added)
+            changed = [self._values[lost], values]
+            self._rows = _concatenate([self._rows[~lost], rows])
+            self._values = _concatenate([self._values[~lost], values])
+        self.elements = _unique(self._values) if self.canonical \
+            else self._values
+        new = _canonical_elements(self)
+        changed = _unique(_concatenate([old, new] if changed is old
+                                       else changed))
+        present, was = _sorted_isin(changed, new), _sorted_isin(changed, old)
+        _notify(self, changed[present & ~was], changed[was & ~present])
+
+    def load_elements(self, path, mmap_mode="r"):
+        """Use the saved elements of the set instead of compute them.
+
+        The elements are a memory map. See NOTE 10.
+        """
+        elements, metadata = _load_elements(path, mmap_mode)
+        if metadata["varnames"] != list(self.varnames):
+            raise ValueError("The saved set have other variables.")
+        self.elements = elements
+        self.canonical = metadata["canonical"]
+        self.engine = "loaded"
+        return self
+
+    # Evaluate a block of the domain with whole arrays if is posible,
+    # otherwise, evaluate it element by element.
+    def _evaluate_block(self, columns):
+        if self.vectorize and all(c.dtype.kind in "biufc" for c in columns):
+            try:
+                return _vectorized_call(self.member, [self.constraint],
+                                        columns)[1]
+            except Exception:
+                pass
+        rows = zip(*[c.tolist() for c in columns])
+        return _element_array(self.member(*r) for r in rows
+                              if self.constraint(*r))
+
+    def iter_chunks(self, size=65536):
+        """Yield the elements in arrays with "size" elements at most.
+
+        Only one block of the domain is in memory each time and the elements
+        are not kept. If the domain is an iterator, it is consumed.
+        """
+        if self.elements is not None:
+            for start in range(0, len(self.elements), size):
+                yield self.elements[start:start + size]
+        elif self.progression is not None:
+            for r in self.progression.ranges:
+                for start in range(0, len(r), size):
+                    yield _sequence_array(r[start:start + size])
+        else:
+            for columns in _domain_blocks(self.domain, len(self.varnames),
+                                          size):
+                elements = self._evaluate_block(columns)
+                if len(elements):
+                    yield elements
+
+    # Evaluate the blocks of the domain in a pool of workers. See NOTE 12.
+    def _parallel_elements(self):
+        executor = self.executor
+        if executor is None:
+            vectorizable = self.vectorize \
+                and _trace(self.member) is not None \
+                and _trace(self.constraint) is not None
+            executor = "thread" if vectorizable else "process"
+        blocks = _domain_blocks(self.domain, len(self.varnames),
+                                self.chunk_size)
+        if executor == "thread":
+            with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+                results = list(pool.map(self._evaluate_block, blocks))
+        elif executor == "process":
+            member = _portable_function(self.member)
+            constraint = _portable_function(self.constraint)
+            rows = ([c.tolist() for c in columns] for columns in blocks)
+            with concurrent.futures.ProcessPoolExecutor(self.workers) as pool:
+                results = list(pool.map(
+                    functools.partial(_evaluate_portable, member, constraint),
+                    rows))
+        else:
+            raise ValueError("The executor must be 'thread' or 'process'.")
+        results = [r for r in results if len(r)]
+        return numpy.concatenate(results) if results else numpy.array([])
+
+    # Evaluate the generator expression with whole arrays if is posible,
+    # otherwise, evaluate it element by element. Report the path taken in
+    # the "engine" attribute.
+    def _materialize(self):
+        if isinstance(self.domain, _SymbolicIterator):
+            if _is_infinite(self):
+                raise TypeError("The set is infinite, use discretize().")
+            elif self.symbolic is None \
+                    or self.symbolic.is_finite_set is not True:
+                raise TypeError("Can not enumerate the set.")
+            self.engine = "symbolic"
+            return numpy.array(
+                sorted(_python_number(v) for v in self.symbolic))
+        if self.progression is not None:
+            self.engine = "progression"
+            return self.progression.to_array()
+        if isinstance(self.domain, _ConstrainedSet) and self.vectorize:
+            elements = pushdown_elements(self, self.chunk_size)
+            if elements is not None:
+                self.engine = "pushdown"
+                return elements
+        if isinstance(self.domain, _ProductIterator) \
+                and self.domain.iterator is None and self.vectorize:
+            elements = join_elements(self.member, self.constraint,
+                                     self.domain.stream)
+            if elements is not None:
+                self.engine = "join"
+                return elements
+        if self.workers is not None:
+            self.engine = "parallel"
+            return self._parallel_elements()
+        if isinstance(self.domain, _StreamIterator) \
+                and self.domain.iterator is None:
+            self.engine = "chunked"
+            chunks = list(self.iter_chunks())
+            return numpy.concatenate(chunks) if chunks else numpy.array([])
+        if self.vectorize:
+            elements = vectorized_elements(self.member, self.constraint,
+                                           self.domain, len(self.varnames))
+            if elements is not None:
+                self.engine = "vectorized"
+                return elements
+        self.engine = "python"
+        if self._stale:
+            chunks = list(self.iter_chunks())
+            return numpy.concatenate(chunks) if chunks else numpy.array([])
+        return _element_array(self.expression)
+
+    def _compute_elements(self):
+        if self.elements is None:
+            elements = _compact(self._materialize(), self.dtype)
+            self.elements = _unique(elements) if self.canonical \
+                else elements
+        return self.elements
+
     def __iter__(self):
         if self.elements is None:
-            self.elements = numpy.array(list(self.expression))
-        return _ConstrainedSet(iter(self.elements), self.constraint)
+            return _ConstrainedSet(None, self.constraint, self)
+        return _ConstrainedSet(self.elements, self.constraint, self)
+
+
+# NOTE 16: A Domain changes with add, discard, update and difference_update.
+# Each change increases its version and is sent to the sets that depend on
+# it, as the values that are new and the values that are no longer present.
+# A Set keeps the rows of the domain that give each element after the first
+# change, so it only evaluates the added rows and removes the elements of the
+# removed rows. An Operation tests the changed values in its operands and
+# puts or removes them in its canonical elements. The sets send their own
+# changes to their dependents in the same way. The caches of the canonical
+# elements and the membership index are valid while the "elements" array is
+# the same object, so they are rebuilt after any change. A Set whose source
+# is a Set with duplicates can not be updated, it is invalidated and computed
+# again when it is needed. The new elements of a Set go at the end.
+
+
+# The dependents are weak references, a set does not keep alive the sets
+# that are built over it
+def _depend(source, dependent):
+    if source._dependents is None:
+        source._dependents = weakref.WeakValueDictionary()
+    source._dependents[id(dependent)] = dependent
+
+
+# Send a change to the dependents, None values invalidate them
+def _notify(s, added, removed):
+    if s._dependents is None:
+        return
+    if added is not None and not (len(added) or len(removed)):
+        return
+    for dependent in list(s._dependents.values()):
+        dependent._source_changed(s, added, removed)
+
+
+def _concatenate(arrays):
+    arrays = [a for a in arrays if len(a)]
+    return numpy.concatenate(arrays) if arrays else numpy.array([])
+
+
+def _any_isin(values, operands, negate=False):
+    mask = numpy.zeros(len(values), dtype=bool)
+    for o in operands:
+        isin = _isin(values, o)
+        mask |= ~isin if negate else isin
+    return mask
+
+
+# NOTE 17: The statistics of a set are the amount of elements, the minimum,
+# the maximum and a HyperLogLog sketch of the distinct elements. They are
+# built in one pass over the elements or over the chunks of a Set that is not
+# computed, and a Domain updates them when values are added. The removals
+# can not be undone in a sketch, so they make the statistics be built again.
+# A HyperLogLog hashes each element, the first bits of the hash choose one of
+# the m registers and the register keeps the largest position of the first
+# one bit of the other bits, so the registers of two sketches merged with a
+# maximum are the sketch of the union. The error is about 1.04/sqrt(m). The
+# intersection is estimated by inclusion–exclusion and the difference by the
+# size of the left operand without the intersection.
+
+
+# Finalizer of splitmix64, the wrapped arithmetic is intended
+def _mix64(x):
+    with numpy.errstate(over="ignore"):
+        x = (x ^ (x >> numpy.uint64(30))) * numpy.uint64(0xbf58476d1ce4e5b9)
+        x = (x ^ (x >> numpy.uint64(27))) * numpy.uint64(0x94d049bb133111eb)
+        return x ^ (x >> numpy.uint64(31))
+
+
+# Hash the elements, or the rows, to 64 bits. The numbers are hashed as
+# floats so the equal integers and floats have the same hash.
+def _hash64(elements):
+    elements = numpy.asarray(elements)
+    if elements.dtype.names:
+        columns = _row_columns(elements)
+        if all(c.dtype.kind in "biuf" for c in columns):
+            elements = numpy.column_stack(
+                [c.astype(numpy.float64) for c in columns])
+    if elements.dtype.kind not in "biuf":
+        return _mix64(numpy.fromiter(
+            (hash(tuple(v) if isinstance(v, list) else v) & (2**64 - 1)
+             for v in elements.tolist()),
+            dtype=numpy.uint64, count=len(elements)))
+    bits = (elements.astype(numpy.float64) + 0.0).view(numpy.uint64)
+    if bits.ndim == 1:
+        return _mix64(bits)
+    hashes = numpy.zeros(len(bits), dtype=numpy.uint64)
+    for column in bits.T:
+        hashes = _mix64(hashes ^ column)
+    return hashes
+
+
+def _leading_zeros(words):
+    count = numpy.zeros(words.shape, dtype=numpy.uint8)
+    for shift in (32, 16, 8, 4, 2, 1):
+        mask = words < numpy.uint64(1) << numpy.uint64(64 - shift)
+        count[mask] += shift
+        words = numpy.where(mask, words << numpy.uint64(shift), words)
+    count[words == 0] += 1
+    return count
+
+
+class HyperLogLog:
+    """A sketch of the amount of distinct elements. See NOTE 17."""
+    def __init__(self, precision=12):
+        self.precision = precision
+        self.registers = numpy.zeros(1 << precision, dtype=numpy.uint8)
+
+    def add(self, elements):
+        """Add an array of elements."""
+        if not len(elements):
+            return
+        hashes = _hash64(elements)
+        p = numpy.uint64(self.precision)
+        index = (hashes >> (numpy.uint64(64) - p)).astype(numpy.intp)
+        ranks = numpy.minimum(_leading_zeros(hashes << p) + 1,
+                              64 - self.precision + 1).astype(numpy.uint8)
+        numpy.maximum.at(self.registers, index, ranks)
+
+    def merge(self, other):
+        """Return the sketch of the union."""
+        if other.precision != self.precision:
+            raise ValueError("The sketches have different precision.")
+        result = HyperLogLog(self.precision)
+        result.registers = numpy.maximum(self.registers, other.registers)
+        return result
+
+    def count(self):
+        """Estimate the amount of distinct elements."""
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / numpy.sum(
+            numpy.ldexp(1.0, -self.registers.astype(int)))
+        zeros = numpy.count_nonzero(self.registers == 0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)
+        return float(estimate)
+
+
+class Statistics:
+    """Count, minimum, maximum and distinct sketch of a set. See NOTE 17.
+
+    The "count" is the amount of elements seen and the bounds are None if
+    the elements are not numbers.
+    """
+    def __init__(self, precision=12):
+        self.count = 0
+        self.minimum = None
+        self.maximum = None
+        self.sketch = HyperLogLog(precision)
+        self.version = None
+
+    def update(self, elements):
+        """Add a chunk of elements."""
+        elements = numpy.asarray(elements)
+        if not len(elements):
+            return self
+        self.count += len(elements)
+        if elements.ndim == 1 and elements.dtype.kind in "biuf":
+            low, high = elements.min(), elements.max()
+            self.minimum = low if self.minimum is None \
+                else min(self.minimum, low)
+            self.maximum = high if self.maximum is None \
+                else max(self.maximum, high)
+        self.sketch.add(elements)
+        return self
+
+    def distinct(self):
+        """Estimate the amount of distinct elements."""
+        return min(self.sketch.count(), self.count)
+
+    def _disjoint(self, other):
+        return None not in (self.minimum, other.minimum) \
+            and (self.maximum < other.minimum or other.maximum < self.minimum)
+
+    def union(self, other):
+        """Estimate the amount of elements of the union."""
+        if not self.count or not other.count:
+            return max(self.distinct(), other.distinct())
+        return max(self.sketch.merge(other.sketch).count(),
+                   self.distinct(), other.distinct())
+
+    def intersection(self, other):
+        """Estimate the amount of elements of the intersection."""
+        if not self.count or not other.count or self._disjoint(other):
+            return 0.0
+        estimate = self.distinct() + other.distinct() - self.union(other)
+        return min(max(estimate, 0.0), self.distinct(), other.distinct())
+
+    def difference(self, other):
+        """Estimate the amount of elements of the difference."""
+        return max(self.distinct() - self.intersection(other), 0.0)
+
+
+# NOTE 18: A BloomFilter answers if a value may be in a set with a bit array
+# of m bits and k positions by element, found with the double hashing
+# h1 + i*h2 of the 64 bits hash of the statistics. A value is surely not in
+# the set if any of its bits is zero. For n elements and an error rate p, the
+# filter uses m = -n*ln(p)/ln(2)^2 bits, about 10 bits by element for 1%,
+# and k = m/n*ln(2) positions.
+
+
+class BloomFilter:
+    """An approximate membership test without false negatives. See NOTE 18.
+    """
+    def __init__(self, capacity, error_rate=0.01):
+        if not 0 < error_rate < 1:
+            raise ValueError("The error rate must be between 0 and 1.")
+        capacity = max(int(capacity), 1)
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(int(math.ceil(-capacity * math.log(error_rate)
+                                      / math.log(2)**2)), 8)
+        self.hashes = max(int(round(self.size / capacity * math.log(2))), 1)
+        self.bits = numpy.zeros((self.size + 7) // 8, dtype=numpy.uint8)
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    def _positions(self, values):
+        first = _hash64(values)
+        second = _mix64(first ^ numpy.uint64(0x9e3779b97f4a7c15)) \
+            | numpy.uint64(1)
+        size = numpy.uint64(self.size)
+        with numpy.errstate(over="ignore"):
+            for i in range(self.hashes):
+                yield ((first + numpy.uint64(i)*second) % size).astype(
+                    numpy.intp)
+
+    def add(self, values):
+        """Add an array of elements."""
+        values = numpy.asarray(values)
+        if not len(values):
+            return
+        for positions in self._positions(values):
+            numpy.bitwise_or.at(self.bits, positions >> 3,
+                                (1 << (positions & 7)).astype(numpy.uint8))
+
+    def isin(self, values):
+        """Return a mask of the values that may be in the set."""
+        values = numpy.asarray(values)
+        mask = numpy.ones(len(values), dtype=bool)
+        if not len(values):
+            return mask
+        for positions in self._positions(values):
+            mask &= (self.bits[positions >> 3] >> (positions & 7)) & 1 == 1
+        return mask
+
+    def __contains__(self, value):
+        return bool(self.isin(numpy.asarray([value]))[0])
+
+    def union(self, other):
+        """Return the filter of the union, the filters must be alike."""
+        if (self.size, self.hashes) != (other.size, other.hashes):
+            raise ValueError("The filters have different sizes.")
+        result = copy.copy(self)
+        result.bits = self.bits | other.bits
+        return result
+
+    __or__ = union
+
+
+def _chunks(s):
+    if s.elements is not None:
+        return [s.elements]
+    if isinstance(s, (Set, StreamDomain)):
+        return s.iter_chunks()
+    if isinstance(s, CartesianProduct):
+        return s.iter_chunks()
+    return [_get_elements(s)]
+
+
+# NOTE 10: A saved set is a directory with the elements in an "elements.npy"
+# file and the metadata in a "metadata.json" file. The elements are loaded
+# with a memory map, so they are not copied, the processes that load the same
+# file share the pages and the set operations over a canonical set read only
+# the pages that the binary searches touch.
+
+
+def _is_canonical(elements):
+    return elements.ndim == 1 and elements.dtype.kind in "biuf" \
+        and bool(numpy.all(elements[1:] > elements[:-1]))
+
+
+def _load_elements(path, mmap_mode):
+    with open(os.path.join(path, "metadata.json")) as file:
+        metadata = json.load(file)
+    elements = numpy.load(os.path.join(path, "elements.npy"),
+                          mmap_mode=mmap_mode, allow_pickle=False)
+    return elements, metadata
+
+
+def load(path, mmap_mode="r"):
+    """Load a saved set as a Domain over a memory map. See NOTE 10."""
+    elements, metadata = _load_elements(path, mmap_mode)
+    domain = Domain(elements)
+    domain.canonical = metadata["canonical"]
+    domain.metadata = metadata
+    return domain
 
 
 class Domain(BaseSet):
-    def __init__(self, iterable):
+    def __init__(self, iterable, canonical=False, dtype=None):
         if isinstance(iterable, numpy.ndarray):
-            self.elements = iterable
+            self.elements = iterable if dtype is None \
+                else iterable.astype(dtype, copy=False)
         elif isinstance(iterable, Domain):
-            self.elements = iterable.elements
+            self.elements = iterable.elements if dtype is None \
+                else iterable.elements.astype(dtype, copy=False)
+            self.canonical = iterable.canonical
+        else:
+            self.elements = _compact(iterable, dtype)
+        if canonical and not self.canonical:
+            self.canonicalize()
+
+    def __iter__(self):
+        return _DomainIterator(self.elements, self)
+
+    def update(self, values):
+        """Add the values that are not in the domain. See NOTE 16."""
+        values = _unique(numpy.asarray(values))
+        if self.elements.ndim == 2 and values.ndim == 1 and len(values):
+            values = values.reshape(1, -1)
+        added = values[~self.isin(values)] if len(self.elements) else values
+        if not len(added):
+            return
+        if not len(self.elements):
+            self.elements = added
+        elif self.canonical:
+            self.elements = _merge_sorted([self.elements, added])
+        else:
+            self.elements = numpy.concatenate([self.elements, added])
+        self.version += 1
+        if self._statistics is not None:
+            self._statistics.update(added).version = self.version
+        _notify(self, added, added[:0])
+
+    def difference_update(self, values):
+        """Remove the values that are in the domain. See NOTE 16."""
+        values = _unique(numpy.asarray(values))
+        if self.elements.ndim == 2 and values.ndim == 1 and len(values):
+            values = values.reshape(1, -1)
+        mask = _sorted_isin(self.elements, values)
+        if not mask.any():
+            return
+        removed = _unique(self.elements[mask])
+        self.elements = self.elements[~mask]
+        self.version += 1
+        _notify(self, removed[:0], removed)
+
+    def add(self, value):
+        """Add a value to the domain."""
+        self.update([value])
+
+    def discard(self, value):
+        """Remove a value from the domain if it is present."""
+        self.difference_update([value])
+
+
+class _DomainIterator(_ArrayIterator):
+    def __init__(self, elements, domain):
+        self.array = elements
+        self.domain = domain
+
+
+# NOTE 9: A StreamDomain is read one block at a time and its elements are
+# never kept in memory. The set operations with streams are done in external
+# memory: each block is sorted and saved in a temporary file (a run), then the
+# runs are merged by groups of _FAN_IN in a balanced tree of block merges and
+# each merged group is saved as a new run, until there are _FAN_IN runs or
+# less, that are merged while they are read. Each run is read in blocks of
+# the size of a block divided by _FAN_IN, so the peak memory is a few blocks.
+# The merge of two sorted streams takes the blocks of both streams up to the
+# smallest of their last values, that way the values of each pair of blocks
+# do not overlap with the next pairs.
+#
+#     runs:  [1 4 9] [2 3 9] [0 5]   ──>   [0 1 2 3 4 5 9]
+
+
+# The number of runs merged at the same time
+_FAN_IN = 16
+
+
+# Yield pairs of blocks of two sorted streams that cover the same values
+def _aligned_blocks(left, right):
+    left, right = iter(left), iter(right)
+    empty = numpy.array([])
+    a, b = next(left, empty), next(right, empty)
+    while len(a) or len(b):
+        if not len(a) or not len(b):
+            yield a, b
+            a = next(left, empty) if len(a) else a[:0]
+            b = next(right, empty) if len(b) else b[:0]
+            continue
+        threshold = min(a[-1], b[-1])
+        i = numpy.searchsorted(a, threshold, side="right")
+        j = numpy.searchsorted(b, threshold, side="right")
+        yield a[:i], b[:j]
+        a, b = a[i:], b[j:]
+        if not len(a):
+            a = next(left, empty)
+        if not len(b):
+            b = next(right, empty)
+
+
+def _union_blocks(left, right):
+    for a, b in _aligned_blocks(left, right):
+        yield _sorted_unique(_merge_sorted([a, b]))
+
+
+def _intersection_blocks(left, right):
+    for a, b in _aligned_blocks(left, right):
+        yield a[_sorted_isin(a, b)]
+
+
+def _difference_blocks(left, right):
+    for a, b in _aligned_blocks(left, right):
+        yield a[~_sorted_isin(a, b)]
+
+
+def _symmetric_difference_blocks(left, right):
+    for a, b in _aligned_blocks(left, right):
+        yield _merge_sorted([a[~_sorted_isin(a, b)], b[~_sorted_isin(b, a)]])
+
+
+_STREAM_PLANS = {"union": _union_blocks,
+                 "intersection": _intersection_blocks,
+                 "difference": _difference_blocks,
+                 "symmetric_difference": _symmetric_difference_blocks}
+
+
+# Yield the arrays in blocks of the given size
+def _rechunk(arrays, size):
+    pending, count = [], 0
+    for array in arrays:
+        pending.append(array)
+        count += len(array)
+        while count >= size:
+            block = _concatenate(pending) if len(pending) > 1 else pending[0]
+            yield block[:size]
+            pending, count = [block[size:]], count - size
+    if count:
+        yield _concatenate(pending)
+
+
+# A run is a list of files with sorted blocks
+def _read_run(paths, size):
+    for path in paths:
+        run = numpy.load(path, mmap_mode="r")
+        for start in range(0, len(run), size):
+            yield numpy.array(run[start:start + size])
+
+
+def _write_run(blocks, directory, size):
+    paths = []
+    for block in _rechunk(blocks, size):
+        fd, path = tempfile.mkstemp(".npy", dir=directory)
+        with os.fdopen(fd, "wb") as f:
+            numpy.save(f, block)
+        paths.append(path)
+    return paths
+
+
+# Merge sorted streams without duplicates in a balanced tree of block merges
+def _merge_runs(streams):
+    while len(streams) > 1:
+        pairs = itertools.zip_longest(streams[::2], streams[1::2],
+                                      fillvalue=())
+        streams = [_union_blocks(a, b) for a, b in pairs]
+    return streams[0] if streams else iter(())
+
+
+# Yield the elements of a set in sorted blocks without duplicates
+def _sorted_blocks(s, size, directory):
+    if isinstance(s, StreamDomain) and s.canonical:
+        yield from s.iter_chunks(size)
+        return
+    if not isinstance(s, StreamDomain):
+        elements = _canonical_elements(s)
+        for start in range(0, len(elements), size):
+            yield elements[start:start + size]
+        return
+    read_size = max(1, size // _FAN_IN)
+    with tempfile.TemporaryDirectory(dir=directory) as temporary:
+        runs = [_write_run([_unique(chunk)], temporary, size)
+                for chunk in s.iter_chunks(size)]
+        while len(runs) > _FAN_IN:
+            groups = [runs[i:i + _FAN_IN]
+                      for i in range(0, len(runs), _FAN_IN)]
+            runs = []
+            for group in groups:
+                merged = _merge_runs([_read_run(r, read_size) for r in group])
+                runs.append(_write_run(merged, temporary, size))
+                for path in itertools.chain.from_iterable(group):
+                    os.remove(path)
+        blocks = _merge_runs([_read_run(r, read_size) for r in runs])
+        for block in _rechunk(blocks, size):
+            if len(block):
+                yield block
+
+
+def _operation(name, left, right):
+    streams = [s for s in (left, right) if isinstance(s, StreamDomain)]
+    if not streams:
+        return Operation(name, left, right)
+    size, directory = streams[0].chunk_size, streams[0].directory
+
+    def blocks():
+        for block in _STREAM_PLANS[name](
+                _sorted_blocks(left, size, directory),
+                _sorted_blocks(right, size, directory)):
+            if len(block):
+                yield block
+    return StreamDomain(blocks, size, directory, canonical=True)
+
+
+class _StreamIterator:
+    def __init__(self, stream):
+        self.stream = stream
+        self.iterator = None
+
+    def __next__(self):
+        if self.iterator is None:
+            self.iterator = itertools.chain.from_iterable(
+                chunk.tolist() for chunk in self.stream.iter_chunks())
+        return next(self.iterator)
+
+    def __iter__(self):
+        return self
+
+
+class _ProductIterator(_StreamIterator):
+    def __next__(self):
+        if self.iterator is None:
+            self.iterator = itertools.product(
+                *[f.tolist() for f in self.stream.factors])
+        return next(self.iterator)
+
+
+class StreamDomain(BaseSet):
+    """A domain that is read one block at a time. See NOTE 9.
+
+    The source is an iterable or a function that return one. Use a function
+    to read the domain more than one time. If canonical is true, the source
+    yields sorted arrays without duplicates.
+    """
+    def __init__(self, source, chunk_size=65536, directory=None,
+                 canonical=False):
+        self.source = source
+        self.chunk_size = chunk_size
+        self.directory = directory
+        self.canonical = canonical
+        self.elements = None
+
+    def iter_chunks(self, size=None):
+        """Yield the elements in arrays."""
+        size = size or self.chunk_size
+        source = self.source() if callable(self.source) else self.source
+        if self.canonical:
+            yield from _rechunk(source, size)
+            return
+        iterator = iter(source)
+        while True:
+            block = list(itertools.islice(iterator, size))
+            if not block:
+                return
+            yield numpy.array(block)
+
+    def __iter__(self):
+        return _StreamIterator(self)
+
+    def __len__(self):
+        return sum(len(chunk) for chunk in self.iter_chunks())
+
+    def __contains__(self, value):
+        return any(value in chunk for chunk in self.iter_chunks())
+
+    def isin(self, values):
+        values = numpy.asarray(values)
+        mask = numpy.zeros(len(values), dtype=bool)
+        for chunk in self.iter_chunks():
+            mask |= _sorted_isin(values, _unique(chunk))
+        return mask
+
+
+# NOTE 8: The number sets are infinite. They are SymbolicSet objects that wrap
+# a SymPy set. A Set over a number set is never iterated: the constraint
+# tree (see NOTE 3) is evaluated with a SymPy symbol as variable, each
+# conjunct is solved with solveset and the member maps the solution with
+# imageset. Only the solutions of rational conditions (with absolute values)
+# that are intervals are kept, and only the images of affine members, since
+# solveset cuts the periodic solutions to one period and imageset closes some
+# open bounds. Otherwise the set has no SymPy set and the membership is
+# decided by the constraint itself. The set operations are done by SymPy,
+# without compute any element.
+#
+#     Set(2*x for x in Reals if 0 < x < 1)  ──>  Interval.open(0, 2)
+
+
+# SymPy version of some builtin, math and NumPy functions
+_SYMPY_FUNCTIONS = {abs: sympy.Abs}
+
+
+# Build a SymPy expression with the expression tree of a trace
+def _sympy_value(node, symbols, namespace):
+    op, args = node
+    if op == "var":
+        return symbols[args[0]]
+    elif op == "const":
+        return sympy.sympify(args[0])
+    elif op == "global":
+        return _load_global(namespace, args[0])
+    elif op == "attr":
+        return getattr(_sympy_value(args[0], symbols, namespace), args[1])
+    elif op == "call":
+        function = _sympy_value(args[0], symbols, namespace)
+        if function in _SYMPY_FUNCTIONS:
+            function = _SYMPY_FUNCTIONS[function]
+        elif getattr(function, "__module__", None) in ("math", "numpy") \
+                or isinstance(function, numpy.ufunc):
+            function = getattr(sympy, function.__name__)
         else:
-            self.elements = numpy.array(iterable)
+            raise _Unsupported("Only math functions are supported.")
+        return function(*[_sympy_value(a, symbols, namespace)
+                          for a in args[1:]])
+    elif op == "binary" and args[0] in "+-*/%**//":
+        return _BINARY_OPERATORS[args[0]](
+            _sympy_value(args[1], symbols, namespace),
+            _sympy_value(args[2], symbols, namespace))
+    elif op == "compare":
+        left = _sympy_value(args[1], symbols, namespace)
+        right = _sympy_value(args[2], symbols, namespace)
+        if args[0] == "==":
+            return sympy.Eq(left, right)
+        elif args[0] == "!=":
+            return sympy.Ne(left, right)
+        return _COMPARE_OPERATORS[args[0]](left, right)
+    elif op == "unary" and args[0] in ("-", "+", "not"):
+        value = _sympy_value(args[1], symbols, namespace)
+        return sympy.Not(value) if args[0] == "not" else \
+            _UNARY_OPERATORS[args[0]](value)
+    raise _Unsupported("The expression can not be converted to SymPy.")
+
+
+# Check that SymPy solves the condition exactly: comparisons of rational
+# functions of the variable, maybe with absolute values
+def _solvable(condition, symbol):
+    if not isinstance(condition, sympy.logic.boolalg.Boolean):
+        return False
+    for relation in condition.atoms(sympy.core.relational.Relational):
+        expression = (relation.lhs - relation.rhs).replace(sympy.Abs,
+                                                           lambda a: a)
+        if expression.is_rational_function(symbol) is not True:
+            return False
+    return True
+
+
+# Check that the solution is a union of SymPy sets of the given kinds
+def _plain_solution(solution, kinds):
+    if isinstance(solution, sympy.Union):
+        return all(_plain_solution(a, kinds) for a in solution.args)
+    return solution.is_empty or isinstance(solution, kinds)
+
+
+# Return the SymPy expression of the member and its variable
+def _symbolic_member(member):
+    trace = _trace(member)
+    if trace is None or trace.conjuncts or member.__code__.co_argcount != 1:
+        raise _Unsupported("The member is not a single expression.")
+    symbol = sympy.Symbol(member.__code__.co_varnames[0])
+    return symbol, _sympy_value(trace.value, [symbol], member.__globals__)
+
+
+def symbolic_set(member, constraint, universe):
+    """Return the SymPy set of the elements of a Set over a number set.
+
+    Return None if the member or the constraint can not be converted to
+    SymPy expressions, if SymPy can not solve the constraint exactly or if
+    the image of the solution by the member is not exact. See NOTE 8.
+    """
+    constraint_trace = _trace(constraint)
+    if constraint_trace is None:
+        return None
+    try:
+        symbol, value = _symbolic_member(member)
+        solution = universe
+        for node in constraint_trace.conjuncts + (constraint_trace.value,):
+            condition = _sympy_value(node, [symbol], constraint.__globals__)
+            if not _solvable(condition, symbol):
+                return None
+            solution = sympy.solveset(condition, symbol, solution)
+    except Exception:
+        return None
+    if solution != universe and not _plain_solution(
+            solution, (sympy.Interval, sympy.FiniteSet, sympy.Range)):
+        return None
+    if value == symbol:
+        return solution
+    elif solution.is_finite_set:
+        return sympy.FiniteSet(*(value.subs(symbol, v) for v in solution))
+    # An affine map keeps the kind of the bounds of the intervals
+    elif value.is_polynomial(symbol) and sympy.degree(value, symbol) == 1 \
+            and _plain_solution(solution, (sympy.Interval, sympy.FiniteSet)):
+        return sympy.imageset(sympy.Lambda(symbol, value), solution)
+    return None
+
+
+# Return the values of the variable that the member maps to the value, or
+# None if SymPy can not find all of them
+def _preimage(member, value):
+    try:
+        symbol, expression = _symbolic_member(member)
+        solution = sympy.solveset(sympy.Eq(expression, value), symbol,
+                                  sympy.S.Complexes)
+    except Exception:
+        return None
+    if not isinstance(solution, sympy.FiniteSet) and not solution.is_empty:
+        return None
+    return [_python_number(v) for v in solution]
+
+
+# Convert the SymPy numbers to python numbers
+def _python_number(value):
+    if value.is_integer:
+        return int(value)
+    elif value.is_real:
+        return float(value)
+    return complex(value)
+
+
+# Check if the set has a SymPy set that is infinite. A Set over an infinite
+# number set without SymPy set can not be enumerated, it is a filter too.
+def _is_infinite(s):
+    if s.symbolic is not None:
+        return s.symbolic.is_finite_set is False
+    domain = getattr(s, "domain", None)
+    return isinstance(domain, _SymbolicIterator) \
+        and domain.universe.symbolic.is_finite_set is False
+
+
+class _SymbolicIterator:
+    def __init__(self, universe):
+        self.universe = universe
+        self.iterator = None
+
+    def __next__(self):
+        if self.iterator is None:
+            if self.universe.symbolic.is_empty:
+                raise StopIteration
+            elif not self.universe.symbolic.is_iterable:
+                raise TypeError("%s is not iterable." % self.universe)
+            self.iterator = iter(self.universe.symbolic)
+        return _python_number(next(self.iterator))
 
     def __iter__(self):
-        return iter(self.elements)
+        return self
+
+
+def _number_predicate(real=True, integer=False, minimum=None):
+    def predicate(values):
+        if values.dtype.kind not in "biufc":
+            return numpy.zeros(values.shape, dtype=bool)
+        with numpy.errstate(invalid="ignore"):
+            mask = numpy.isfinite(values)
+            if real:
+                mask &= numpy.isreal(values)
+                values = numpy.real(values)
+            if integer:
+                mask &= numpy.floor(values) == values
+            if minimum is not None:
+                mask &= values >= minimum
+        return mask
+    return predicate
+
+
+class SymbolicSet(BaseSet):
+    """A set of numbers given by a SymPy set. See NOTE 8."""
+    def __init__(self, symbolic, name=None, predicate=None):
+        self.symbolic = symbolic
+        self.name = name or str(symbolic)
+        self.predicate = predicate
+        self.elements = None
+
+    def __repr__(self):
+        return self.name
+
+    __str__ = __repr__
+
+    def __iter__(self):
+        return _SymbolicIterator(self)
+
+    def __len__(self):
+        if self.symbolic.is_finite_set:
+            return len(self.symbolic)
+        raise TypeError("%s is infinite." % self)
+
+    def __contains__(self, value):
+        return bool(self.isin([value])[0])
+
+    def isin(self, values):
+        values = numpy.asarray(values)
+        if self.predicate is not None:
+            return self.predicate(values)
+        return numpy.fromiter(
+            (self.symbolic.contains(v) == sympy.true for v in values),
+            dtype=bool, count=len(values))
+
+
+Universal = U  = SymbolicSet(sympy.S.UniversalSet, "𝕌",
+                             lambda v: numpy.ones(v.shape, dtype=bool))
+Naturals0 = N0 = SymbolicSet(sympy.S.Naturals0, "ℕ0",
+                             _number_predicate(integer=True, minimum=0))
+Naturals1 = N1 = SymbolicSet(sympy.S.Naturals, "ℕ1",
+                             _number_predicate(integer=True, minimum=1))
+Integers  = Z  = SymbolicSet(sympy.S.Integers, "ℤ",
+                             _number_predicate(integer=True))
+Rationals = Q  = SymbolicSet(sympy.S.Rationals, "ℚ", _number_predicate())
+Reals     = R  = SymbolicSet(sympy.S.Reals, "ℝ", _number_predicate())
+Complexes = C  = SymbolicSet(sympy.S.Complexes, "ℂ",
+                             _number_predicate(real=False))
+Empty     = E  = SymbolicSet(sympy.S.EmptySet, "Ø",
+                             lambda v: numpy.zeros(v.shape, dtype=bool))
+
+
+# NOTE 13: The profiler replaces the functions of the hot paths with timed
+# wrappers when it is enabled and puts the original functions back when it is
+# disabled, so it costs nothing while it is off. The statistics are grouped
+# by function and by generator expression, that is named by the file and the
+# line of its code, or of the code of its member. The elements are the rows
+# of the arrays that are returned (a tuple of arrays are columns of the same
+# rows) and the bytes are the size of that arrays.
+
+
+PhaseStats = collections.namedtuple("PhaseStats",
+                                    "calls seconds elements bytes")
+
+
+# The wrapped functions: the owner (None for the module), the attribute name
+_PROFILED = [(None, "_parse_generator"),
+             ("Set", "_materialize"),
+             (None, "_vectorized_call"),
+             (None, "_canonical_elements"),
+             (None, "_sorted_isin"),
+             (None, "_merge_sorted"),
+             (None, "_sorted_unique"),
+             ("_MembershipIndex", "__init__")]
+
+
+# Name of the generator expression of the first argument of a call
+def _profile_label(args):
+    if not args:
+        return ""
+    source = args[0]
+    if isinstance(source, Set):
+        source = source.expression
+    code = getattr(source, "gi_code", None) \
+        or getattr(source, "__code__", None)
+    if code is None:
+        return ""
+    return "%s:%d" % (code.co_filename, code.co_firstlineno)
+
+
+def _result_arrays(result):
+    if isinstance(result, numpy.ndarray):
+        return [result]
+    if isinstance(result, tuple):
+        return [r for r in result if isinstance(r, numpy.ndarray)]
+    return []
+
+
+class Profiler:
+    """Timings, calls, elements and bytes of the hot paths. See NOTE 13.
+
+    The "span" function, if it is given, is called at the end of every call
+    with the name, the label, the start time and the duration.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.span = None
+        self._stats = {}
+        self._originals = []
+        self._lock = threading.Lock()
+
+    def _record(self, name, label, start, duration, result):
+        arrays = _result_arrays(result)
+        elements = len(arrays[0]) if arrays and arrays[0].ndim else 0
+        size = sum(a.nbytes for a in arrays)
+        with self._lock:
+            calls, seconds, count, total = self._stats.get(
+                (name, label), (0, 0.0, 0, 0))
+            self._stats[name, label] = PhaseStats(
+                calls + 1, seconds + duration, count + elements,
+                total + size)
+        if self.span is not None:
+            self.span(name, label, start, duration)
+
+    def _wrap(self, function, name):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            result = function(*args, **kwargs)
+            duration = time.perf_counter() - start
+            self._record(name, _profile_label(args), start, duration, result)
+            return result
+        return wrapper
+
+    def enable(self, span=None):
+        """Start to record the statistics."""
+        self.span = span
+        if self.enabled:
+            return
+        module = sys.modules[__name__]
+        targets = [(getattr(module, o) if o else module, a)
+                   for o, a in _PROFILED]
+        targets += [(_PLANS, name) for name in _PLANS]
+        for owner, attribute in targets:
+            if isinstance(owner, dict):
+                function = owner[attribute]
+                owner[attribute] = self._wrap(function, function.__name__)
+            else:
+                function = getattr(owner, attribute)
+                setattr(owner, attribute,
+                        self._wrap(function, function.__qualname__))
+            self._originals.append((owner, attribute, function))
+        self.enabled = True
+
+    def disable(self):
+        """Stop to record the statistics, they are kept."""
+        for owner, attribute, function in reversed(self._originals):
+            if isinstance(owner, dict):
+                owner[attribute] = function
+            else:
+                setattr(owner, attribute, function)
+        self._originals.clear()
+        self.enabled = False
+
+    def stats(self):
+        """Return a snapshot of the statistics keyed by name and label."""
+        with self._lock:
+            return dict(self._stats)
+
+    def reset(self):
+        """Remove all the statistics."""
+        with self._lock:
+            self._stats.clear()
+
+    def __enter__(self):
+        self.enable(self.span)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.disable()
 
 
-Universal = U  = "𝕌"
-Naturals0 = N0 = "ℕ0"
-Naturals1 = N1 = "ℕ1"
-Integers  = Z  = "ℤ"
-Rationals = Q  = "ℚ"
-Reals     = R  = "ℝ"
-Complexes = C  = "ℂ"
-Empty     = E  = "Ø"
+profiler = Profiler()
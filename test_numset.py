@@ -1,9 +1,19 @@
+import importlib
+import os
+import sys
+import tempfile
 import unittest
 import numpy
 import dis
+import itertools
+import math
+import sympy
 
 from numset import (Set, generator_to_function, get_constraints, get_member,
-                    Domain)
+                    Domain, CodeCache, Operation, Progression, Reals, R,
+                    Integers, Naturals1, Empty, StreamDomain, load,
+                    CartesianProduct, Profiler,
+                    HyperLogLog, estimate_size, BloomFilter, Sum)
 
 
 class GeneratorToFunctionSuite(unittest.TestCase):
@@ -118,6 +128,48 @@ class GetMememberSuite(unittest.TestCase):
         self.assertEqual(obtained.__name__, "<member>")
 
 
+class CodeCacheSuite(unittest.TestCase):
+    def setUp(self):
+        self.builds = []
+
+    def build(self, generator):
+        self.builds.append(generator)
+        return generator.gi_code
+
+    def test_hits_and_misses(self):
+        cache = CodeCache(maxsize=2)
+        for i in range(3):
+            generator = (x for x in ())
+            self.assertIs(cache.lookup(generator, "member", self.build),
+                          generator.gi_code)
+        self.assertEqual(len(self.builds), 1)
+        self.assertEqual(tuple(cache.info()), (2, 1, 2, 1))
+
+    def test_parts(self):
+        cache = CodeCache()
+        generator = (x for x in ())
+        cache.lookup(generator, "member", self.build)
+        cache.lookup(generator, "constraint", self.build)
+        self.assertEqual(len(self.builds), 2)
+        self.assertEqual(cache.info().currsize, 1)
+
+    def test_eviction(self):
+        cache = CodeCache(maxsize=2)
+        first = (x for x in ())
+        cache.lookup(first, "member", self.build)
+        cache.lookup((y for y in ()), "member", self.build)
+        cache.lookup((z for z in ()), "member", self.build)
+        self.assertEqual(cache.info().currsize, 2)
+        cache.lookup(first, "member", self.build)
+        self.assertEqual(cache.info().misses, 4)
+
+    def test_clear(self):
+        cache = CodeCache()
+        cache.lookup((x for x in ()), "member", self.build)
+        cache.clear()
+        self.assertEqual(tuple(cache.info()), (0, 0, 256, 0))
+
+
 class SetSuite(unittest.TestCase):
     def test_domain(self):
         domain = iter(range(5))
@@ -222,12 +274,14 @@ class SetOperationsSuite(unittest.TestCase):
     def test_greater_than(self):
         A = Set(x for x in range(0, 5))
         B = Set(x for x in range(0, 10))
-        self.assertGreater(A, B)
+        self.assertGreater(B, A)
+        self.assertFalse(A > B)
 
     def test_greater_equal(self):
         A = Set(x for x in range(0, 5))
         B = Set(x for x in range(0, 10))
-        self.assertGreaterEqual(A, B)
+        self.assertGreaterEqual(B, A)
+        self.assertFalse(A >= B)
         C = Set(x for x in range(5))
         D = Set(x for x in range(5))
         self.assertGreaterEqual(C, D)
@@ -285,6 +339,1017 @@ class SetOperationsSuite(unittest.TestCase):
         self.assertEqual(E, F)
 
 
+class OperationSuite(unittest.TestCase):
+    def test_lazy(self):
+        A = Set(x for x in range(5))
+        B = Set(x for x in range(5, 10))
+        C = A | B
+        self.assertIsInstance(C, Operation)
+        self.assertIsNone(A.elements)
+        self.assertIsNone(C.elements)
+        self.assertEqual(list(C), list(range(10)))
+
+    def test_fuse_associative(self):
+        A, B, C = Domain([1]), Domain([2]), Domain([3])
+        self.assertEqual(len(((A | B) | C).operands), 3)
+        self.assertEqual(len((A & (B & C)).operands), 3)
+        self.assertEqual(len(((A | B) & C).operands), 2)
+
+    def test_fuse_difference(self):
+        A, B, C = Domain([1]), Domain([2]), Domain([3])
+        self.assertEqual(len(((A - B) - C).operands), 3)
+        self.assertEqual(len((A - (B - C)).operands), 2)
+
+    def test_chain(self):
+        A = Domain([1, 2, 3, 4])
+        B = Domain([5, 6])
+        C = Domain([2, 4, 6, 8])
+        D = Domain([4])
+        self.assertEqual(list((A | B) & C - D), [2, 6])
+        self.assertEqual(list(A - B - C), [1, 3])
+        self.assertEqual(list(A - (C - D)), [1, 3, 4])
+
+    def test_smallest_intersection_first(self):
+        A = Set(x for x in range(10**6))
+        B = Domain([])
+        self.assertEqual(list(A & B), [])
+        self.assertIsNone(A.elements)
+
+    def test_many_symmetric_difference(self):
+        A = Domain([1, 2, 3])
+        B = Domain([2, 3, 4])
+        C = Domain([3, 4, 5])
+        self.assertEqual(list(A ^ B ^ C), [1, 3, 5])
+
+    def test_domain_of_set(self):
+        A = Domain([1, 2, 3])
+        B = Domain([3, 4])
+        C = Set(x*10 for x in A | B)
+        self.assertEqual(list(C), [10, 20, 30, 40])
+
+
+class CanonicalSuite(unittest.TestCase):
+    def test_domain(self):
+        A = Domain([3, 1, 2, 3], canonical=True)
+        self.assertTrue(A.canonical)
+        self.assertEqual(list(A), [1, 2, 3])
+        self.assertTrue(Domain(A).canonical)
+
+    def test_set(self):
+        A = Set((x % 3 for x in range(10)), canonical=True)
+        self.assertEqual(list(A), [0, 1, 2])
+        self.assertTrue(A.canonical)
+
+    def test_canonicalize(self):
+        A = Domain([5, 4, 5])
+        self.assertFalse(A.canonical)
+        self.assertIs(A.canonicalize(), A)
+        self.assertEqual(list(A), [4, 5])
+        self.assertTrue(A.canonical)
+
+    def test_operations_are_canonical(self):
+        A = Domain([4, 1, 1, 9], canonical=True)
+        B = Domain([9, 3, 3, 1])
+        self.assertEqual(list(A | B), [1, 3, 4, 9])
+        self.assertEqual(list(A & B), [1, 9])
+        self.assertEqual(list(A - B), [4])
+        self.assertEqual(list(A ^ B), [3, 4])
+        self.assertTrue((A | B).canonical)
+
+    def test_non_canonical_elements_are_kept(self):
+        A = Domain([3, 1, 3])
+        self.assertEqual(list(A | Domain([2])), [1, 2, 3])
+        self.assertEqual(list(A), [3, 1, 3])
+
+    def test_isdisjoint(self):
+        A = Domain([5, 1], canonical=True)
+        self.assertTrue(A.isdisjoint(Domain([2, 7, 0])))
+        self.assertFalse(A.isdisjoint(Domain([9, 5])))
+
+
+class MembershipSuite(unittest.TestCase):
+    def test_bitmap(self):
+        A = Set(x for x in list(range(0, 100, 2)))
+        self.assertIn(50, A)
+        self.assertIn(50.0, A)
+        self.assertNotIn(51, A)
+        self.assertNotIn(50.5, A)
+        self.assertNotIn(100, A)
+        self.assertNotIn(-2, A)
+        self.assertNotIn("a", A)
+        self.assertEqual(A._index.kind, "bitmap")
+
+    def test_sorted(self):
+        A = Domain([10**9, 3, 10**6], canonical=True)
+        self.assertIn(10**6, A)
+        self.assertNotIn(4, A)
+        self.assertNotIn(10**10, A)
+        self.assertEqual(A._index.kind, "sorted")
+
+    def test_hash(self):
+        A = Domain(["b", "a"])
+        self.assertIn("a", A)
+        self.assertNotIn("c", A)
+        self.assertNotIn(1, A)
+        self.assertEqual(A._index.kind, "hash")
+
+    def test_rows(self):
+        A = Domain([(0, 3), (1, 4)])
+        self.assertIn((1, 4), A)
+        self.assertNotIn((4, 1), A)
+
+    def test_index_is_kept(self):
+        A = Domain([1, 2, 3])
+        self.assertIn(1, A)
+        index = A._index
+        self.assertIn(2, A)
+        self.assertIs(A._index, index)
+        A.elements = numpy.array([7])
+        self.assertIn(7, A)
+        self.assertNotIn(1, A)
+
+    def test_product_and_sum(self):
+        A = Domain([0, 1])
+        B = Domain([3, 4])
+        self.assertIn((1, 4), A*B)
+        self.assertNotIn((1, 3), A*B)
+        self.assertIn(4, A + B)
+        self.assertNotIn(5, A + B)
+
+
+class BatchSuite(unittest.TestCase):
+    def test_isin(self):
+        A = Set(x for x in range(0, 10, 2))
+        mask = A.isin([0, 1, 2.0, 2.5, 8, 10, -2])
+        self.assertEqual(mask.tolist(),
+                         [True, False, True, False, True, False, False])
+
+    def test_isin_sorted_and_hash(self):
+        A = Domain([10**9, 3], canonical=True)
+        self.assertEqual(A.isin([3, 4, 10**9]).tolist(), [True, False, True])
+        B = Domain(["b", "a"])
+        self.assertEqual(B.isin(["a", "c"]).tolist(), [True, False])
+        C = Domain([(0, 3), (1, 4)])
+        self.assertEqual(C.isin([(1, 4), (4, 1)]).tolist(), [True, False])
+
+    def test_apply(self):
+        add_ten = Set(x + 10 for x in range(10) if x < 5)
+        result = add_ten.apply(numpy.array([1, 7, 3]))
+        self.assertEqual(result[[0, 2]].tolist(), [11.0, 13.0])
+        self.assertTrue(numpy.isnan(result[1]))
+
+    def test_apply_masked(self):
+        add_ten = Set(x + 10 for x in range(10) if x < 5)
+        result = add_ten.apply([1, 7, 3], masked=True)
+        self.assertEqual(result.mask.tolist(), [False, True, False])
+        self.assertEqual(result.compressed().tolist(), [11, 13])
+
+    def test_apply_nested(self):
+        A = Set(x for x in () if x < 5)
+        add_ten = Set(x + 10 for x in A)
+        result = add_ten.apply([4, 6], masked=True)
+        self.assertEqual(result.mask.tolist(), [False, True])
+        self.assertEqual(result[0], 14)
+
+    def test_apply_many_variables(self):
+        A = Set(x*y for x, y in () if x != y)
+        result = A.apply([1, 2, 3], [3, 2, 1], masked=True)
+        self.assertEqual(result.tolist(), [3, None, 3])
+
+    def test_apply_python_path(self):
+        A = Set(max(x, 2) for x in () if x != 1)
+        result = A.apply([0, 1, 5], masked=True)
+        self.assertEqual(result.tolist(), [2, None, 5])
+
+
+class ProgressionSuite(unittest.TestCase):
+    def test_affine_and_congruence(self):
+        A = Set(3*x + 1 for x in range(100) if x % 4 == 0)
+        self.assertEqual(A.progression.ranges, (range(1, 301, 12),))
+        self.assertEqual(len(A), 25)
+        self.assertIn(13, A)
+        self.assertIn(13.0, A)
+        self.assertNotIn(4, A)
+        self.assertNotIn(301, A)
+        self.assertIsNone(A.elements)
+        self.assertEqual(list(A), [3*x + 1 for x in range(100) if x % 4 == 0])
+        self.assertEqual(A.engine, "progression")
+
+    def test_bounds(self):
+        A = Set(x for x in range(100) if x > 10 and 2*x <= 41 and x != 15)
+        self.assertIsNone(A.progression)
+        B = Set(-x for x in range(100) if x > 10 and 2*x <= 41)
+        self.assertEqual(list(B), [-x for x in range(11, 21)])
+        C = Set(x for x in range(10) if x % 2 != 0 if x >= 4.5)
+        self.assertEqual(list(C), [5, 7, 9])
+
+    def test_negative_step(self):
+        A = Set(x for x in range(10, 0, -3))
+        self.assertEqual(list(A), [10, 7, 4, 1])
+
+    def test_unsatisfiable(self):
+        A = Set(x for x in range(10) if x % 3 == 5)
+        self.assertEqual(len(A), 0)
+        self.assertEqual(list(A), [])
+
+    def test_operations(self):
+        A = Set(x for x in range(0, 1000, 2))
+        B = Set(x for x in range(0, 1000, 3))
+        self.assertEqual(len(A & B), len(range(0, 1000, 6)))
+        self.assertEqual(len(A | B), 667)
+        self.assertEqual(len(A - B), 333)
+        self.assertEqual(len(A ^ B), 500)
+        self.assertIn(6, A & B)
+        self.assertNotIn(6, A - B)
+        self.assertIsNone(A.elements)
+        self.assertIsNone(B.elements)
+        self.assertEqual(list(A & B), list(range(0, 1000, 6)))
+        expected = sorted(set(range(0, 1000, 2)) - set(range(0, 1000, 3)))
+        self.assertEqual(list(A - B), expected)
+
+    def test_not_affine(self):
+        A = Set(x*x for x in range(5))
+        self.assertIsNone(A.progression)
+        self.assertEqual(list(A), [0, 1, 4, 9, 16])
+
+    def test_progression(self):
+        A = Progression(range(0, 10), range(20, 30, 2))
+        self.assertEqual(len(A), 15)
+        self.assertIn(24, A)
+        self.assertNotIn(25, A)
+        self.assertNotIn(2.5, A)
+        self.assertEqual(sorted(A.difference(Progression(range(0, 30, 4)))),
+                         [1, 2, 3, 5, 6, 7, 9, 22, 26])
+
+
+class SymbolicSuite(unittest.TestCase):
+    def test_constants(self):
+        self.assertIs(R, Reals)
+        self.assertEqual(str(Reals), "ℝ")
+        self.assertIn(0.5, Reals)
+        self.assertNotIn(1j, Reals)
+        self.assertIn(3, Naturals1)
+        self.assertNotIn(0, Naturals1)
+        self.assertNotIn(2.5, Integers)
+        self.assertEqual(list(Empty), [])
+
+    def test_interval(self):
+        A = Set(x for x in Reals if 0 < x < 1)
+        self.assertEqual(A.symbolic, sympy.Interval.open(0, 1))
+        self.assertIn(0.5, A)
+        self.assertNotIn(1, A)
+        with self.assertRaises(TypeError):
+            len(A)
+        with self.assertRaises(TypeError):
+            list(A)
+
+    def test_image(self):
+        A = Set(2*x for x in Reals if 0 < x and x <= 1)
+        self.assertEqual(A.symbolic, sympy.Interval.Lopen(0, 2))
+
+    def test_open_image(self):
+        A = Set(x**2 for x in Reals if x > 0)
+        self.assertIsNone(A.symbolic)
+        self.assertNotIn(0, A)
+        self.assertIn(4, A)
+        with self.assertRaises(TypeError):
+            len(A)
+
+    def test_finite_image(self):
+        A = Set(x + 0.5 for x in Integers if 0 <= x < 3)
+        self.assertEqual(list(A), [0.5, 1.5, 2.5])
+
+    def test_periodic(self):
+        A = Set(x for x in Reals if math.sin(x) > 0)
+        self.assertIsNone(A.symbolic)
+        self.assertIn(7.0, A)
+        self.assertNotIn(4.0, A)
+        self.assertIn(-0.5, Set(x for x in Reals if numpy.cos(x) > 0))
+        with self.assertRaises(TypeError):
+            A <= Set(x for x in Reals if x > 0)
+        self.assertEqual(list(Domain([0.5, 4.0, 7.0]) & A), [0.5, 7.0])
+
+    def test_operations(self):
+        A = Set(x for x in Reals if 0 < x < 1)
+        B = Set(x for x in Reals if x > 0.5)
+        self.assertEqual((A & B).symbolic, sympy.Interval.open(0.5, 1))
+        self.assertEqual((A | B).symbolic, sympy.Interval.open(0, sympy.oo))
+        self.assertIn(0.25, A - B)
+        self.assertNotIn(0.75, A - B)
+        self.assertEqual(A & B, Set(y for y in Reals if 0.5 < y < 1))
+
+    def test_finite_integers(self):
+        A = Set(x for x in Integers if 0 <= x and x < 5)
+        self.assertEqual(list(A), [0, 1, 2, 3, 4])
+        self.assertEqual(len(A), 5)
+
+    def test_constraint_membership(self):
+        A = Set(x for x in Reals if x % 2 == 0)
+        self.assertIn(4.0, A)
+        self.assertNotIn(3.0, A)
+
+    def test_finite_filter(self):
+        A = Set(x for x in Reals if 0 < x < 1)
+        self.assertEqual(list(Domain([0.5, 2, 0.25]) & A), [0.25, 0.5])
+        self.assertEqual(list(Domain([0.5, 2]) - A), [2])
+
+    def test_discretize(self):
+        A = Set(x for x in Reals if 0 < x < 1)
+        self.assertEqual(list(A.discretize(num=5)), [0.25, 0.5, 0.75])
+        with self.assertRaises(ValueError):
+            Reals.discretize()
+        self.assertEqual(list(Integers.discretize(0, 2, 5)), [0, 1, 2])
+
+
+class StreamSuite(unittest.TestCase):
+    def test_iter_chunks(self):
+        A = Set(x*x for x in list(range(10)) if x % 2 == 0)
+        chunks = list(A.iter_chunks(2))
+        self.assertTrue(all(len(c) <= 2 for c in chunks))
+        self.assertEqual(numpy.concatenate(chunks).tolist(),
+                         [0, 4, 16, 36, 64])
+        self.assertIsNone(A.elements)
+
+    def test_stream_domain(self):
+        D = StreamDomain(lambda: range(100), chunk_size=7)
+        self.assertEqual(len(D), 100)
+        self.assertIn(42, D)
+        A = Set(x + 1 for x in D if x < 10)
+        self.assertEqual(list(A), list(range(1, 11)))
+        self.assertEqual(A.engine, "chunked")
+
+    def test_objects(self):
+        A = Set(x for (x, y) in [(1, "a"), (2, "b")] if y == "b")
+        chunks = list(A.iter_chunks(1))
+        self.assertEqual(numpy.concatenate(chunks).tolist(), [2])
+
+    def test_external_operations(self):
+        numbers = numpy.random.RandomState(0).randint(0, 500, 2000)
+        D = StreamDomain(lambda: numbers, chunk_size=64)
+        E = StreamDomain(lambda: range(250, 750), chunk_size=64)
+        a, b = set(numbers.tolist()), set(range(250, 750))
+        self.assertEqual(list(D | E), sorted(a | b))
+        self.assertEqual(list(D & E), sorted(a & b))
+        self.assertEqual(list(D - E), sorted(a - b))
+        self.assertEqual(list(D ^ E), sorted(a ^ b))
+        self.assertEqual(list(D & Domain(range(10))),
+                         sorted(a & set(range(10))))
+
+    def test_merge_passes(self):
+        numbers = numpy.random.RandomState(1).randint(0, 300, 2000)
+        D = StreamDomain(lambda: numbers, chunk_size=8)
+        E = D | StreamDomain(lambda: range(100), chunk_size=8)
+        chunks = list(E.iter_chunks())
+        self.assertTrue(all(len(c) == 8 for c in chunks[:-1]))
+        self.assertEqual(numpy.concatenate(chunks).tolist(),
+                         sorted(set(numbers.tolist()) | set(range(100))))
+        self.assertTrue(all(len(c) == 5 for c in list(E.iter_chunks(5))[:-1]))
+
+
+class PersistenceSuite(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "set")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_save_load(self):
+        A = Set(x*x for x in list(range(10)) if x % 2 == 0)
+        A.save(self.path)
+        D = load(self.path)
+        self.assertIsInstance(D.elements, numpy.memmap)
+        self.assertTrue(D.canonical)
+        self.assertEqual(D.metadata["varnames"], ["x"])
+        self.assertEqual(list(D), [0, 4, 16, 36, 64])
+        self.assertIn(16, D)
+        self.assertEqual(list(D & Domain([4, 5, 64])), [4, 64])
+
+    def test_load_elements(self):
+        A = Set(x - 1 for x in list(range(5)))
+        A.save(self.path)
+        B = Set(x - 1 for x in list(range(5))).load_elements(self.path)
+        self.assertEqual(B.engine, "loaded")
+        self.assertEqual(list(B), [-1, 0, 1, 2, 3])
+        with self.assertRaises(ValueError):
+            Set(y for y in list(range(5))).load_elements(self.path)
+
+    def test_objects(self):
+        with self.assertRaises(ValueError):
+            Domain(numpy.array([None, 1])).save(self.path)
+
+
+class CartesianProductSuite(unittest.TestCase):
+    def test_elements(self):
+        A = Domain([0, 1, 2])
+        B = Domain([3, 4])
+        P = A.cartesian(B)
+        self.assertEqual(len(P), 6)
+        self.assertEqual(list(P), list(itertools.product([0, 1, 2], [3, 4])))
+        self.assertEqual(P[3], (1, 4))
+        self.assertEqual(P[-1], (2, 4))
+        self.assertEqual(P[1:3].tolist(), [[0, 4], [1, 3]])
+        with self.assertRaises(IndexError):
+            P[6]
+        self.assertIn((2, 3), P)
+        self.assertNotIn((3, 2), P)
+
+    def test_flatten(self):
+        A = Domain([0, 1])
+        P = A.cartesian(A).cartesian(A)
+        self.assertEqual(len(P.sets), 3)
+        self.assertEqual(P, A.cartesian_power(3))
+
+    def test_set(self):
+        A = Domain(numpy.arange(100))
+        B = Set((x, y) for x, y in A.cartesian_power(2) if x + y == 10)
+        self.assertEqual(B.engine, None)
+        expected = [(x, 10 - x) for x in range(11)]
+        self.assertEqual([tuple(e) for e in B], expected)
+        self.assertEqual(B.engine, "chunked")
+        chunks = list(CartesianProduct(A, A).iter_chunks(1000))
+        self.assertEqual([len(c) for c in chunks], [1000]*10)
+
+    def test_join(self):
+        A = Domain(numpy.arange(1000))
+        B = Domain(numpy.arange(500, 1500))
+        C = Set((x, y) for x, y in A.cartesian(B) if x == y and x % 100 == 0)
+        self.assertEqual([tuple(r) for r in C],
+                         [(x, x) for x in range(500, 1000, 100)])
+        self.assertEqual(C.engine, "join")
+
+    def test_range_join(self):
+        A, B = Domain([3, 1, 2]), Domain([2.5, numpy.nan, 0.5])
+        C = Set((x, y) for x, y in A.cartesian(B) if 2*x < y + 2)
+        expected = [(x, y) for x, y in itertools.product([3, 1, 2],
+                                                        [2.5, numpy.nan, 0.5])
+                    if 2*x < y + 2]
+        self.assertEqual([tuple(r) for r in C], expected)
+        self.assertEqual(C.engine, "join")
+
+
+    def test_hash_join(self):
+        reads = []
+
+        class Row:
+            def __init__(self, key, name):
+                self._key, self.name = key, name
+
+            @property
+            def key(self):
+                reads.append(self)
+                return self._key
+
+        A = Domain([Row(i, "a%d" % i) for i in range(100)])
+        B = Domain([Row(i % 10, "b%d" % i) for i in range(100)])
+        C = Set((x.name, y.name) for x, y in A.cartesian(B)
+                if x.key == y.key)
+        expected = [(x.name, y.name) for x in A for y in B
+                    if x._key == y._key]
+        reads.clear()
+        self.assertEqual([tuple(r) for r in C], expected)
+        self.assertEqual(C.engine, "join")
+        self.assertLess(len(reads), 2*(200 + len(expected)))
+
+
+class RowSuite(unittest.TestCase):
+    def setUp(self):
+        A = Domain(numpy.arange(4))
+        self.B = Set((x, y) for x, y in A.cartesian(A) if x < y)
+        self.C = Set((x, y) for x, y in A.cartesian(A) if x + y == 3)
+
+    def rows(self, s):
+        return [tuple(r) for r in s]
+
+    def test_columns(self):
+        self.assertEqual(len(list(self.B)), 6)
+        self.assertEqual(self.B.elements.shape, (6, 2))
+        self.assertEqual(self.B.elements.dtype, numpy.int8)
+
+    def test_operations(self):
+        b = {(0, 1), (0, 2), (0, 3), (1, 2), (1, 3), (2, 3)}
+        c = {(0, 3), (1, 2), (2, 1), (3, 0)}
+        self.assertEqual(self.rows(self.B | self.C), sorted(b | c))
+        self.assertEqual(self.rows(self.B & self.C), sorted(b & c))
+        self.assertEqual(self.rows(self.B - self.C), sorted(b - c))
+        self.assertEqual(self.rows(self.B ^ self.C), sorted(b ^ c))
+
+    def test_equality(self):
+        D = Domain([(2, 3), (0, 1), (1, 3), (0, 2), (1, 2), (0, 3)])
+        self.assertEqual(self.B, D)
+        self.assertIn((1, 3), D)
+        self.assertNotIn((3, 1), D)
+        self.assertNotIn(1, D)
+
+    def test_mixed_columns(self):
+        T = Set((x, y) for x, y in zip([1, 2], ["a", "b"]))
+        self.assertEqual(list(T), [(1, "a"), (2, "b")])
+        self.assertEqual(T.elements.dtype.names, ("f0", "f1"))
+        self.assertIn((1, "a"), T)
+        self.assertNotIn(("1", "a"), T)
+        self.assertEqual(T.isin([(2, "b"), (2, "a")]).tolist(), [True, False])
+        self.assertEqual(list(T | Domain([(0, "c")])),
+                         [(0, "c"), (1, "a"), (2, "b")])
+
+    def test_integer_precision(self):
+        A = Set((x, y) for x, y in zip([2**60 + 1, 1], [0.5, 1.5]))
+        self.assertEqual(list(A), [(2**60 + 1, 0.5), (1, 1.5)])
+        self.assertIn((2**60 + 1, 0.5), A)
+        self.assertEqual(A, Domain([(1, 1.5), (2**60 + 1, 0.5)]))
+
+
+class PushdownSuite(unittest.TestCase):
+    def test_nested(self):
+        domain = list(range(-20, 20))
+        A = Set(x*x for x in domain if x > -10)
+        B = Set(y + 1 for y in A if y < 50)
+        self.assertEqual(list(B), [x*x + 1 for x in domain
+                                   if x > -10 and x*x < 50])
+        self.assertEqual(B.engine, "pushdown")
+        self.assertIsNone(A.elements)
+
+    def test_tuples(self):
+        A = Set((x, x + 1) for x in list(range(-9, 9)) if x % 3 == 0)
+        B = Set(a*b for a, b in A if a > 0)
+        self.assertEqual(list(B), [12, 42])
+
+    def test_reorder(self):
+        import numset
+        A = Set(x for x in numpy.arange(10000) if x % 7 < 7)
+        B = Set((y for y in A if y < 10), chunk_size=1000)
+        evaluate, evaluated = numset._evaluate, []
+
+        def recorder(node, columns, namespace, cache):
+            if node.op == "compare":
+                evaluated.append(node.args[1].op)
+            return evaluate(node, columns, namespace, cache)
+        numset._evaluate = recorder
+        try:
+            self.assertEqual(list(B), list(range(10)))
+        finally:
+            numset._evaluate = evaluate
+        self.assertEqual(B.engine, "pushdown")
+        # "x % 7 < 7" never rejects a row, after the first block "y < 10"
+        # goes first and rejects all the rows of the next blocks
+        self.assertEqual(evaluated, ["binary", "var"] + ["var"]*9)
+
+    def test_fall_back(self):
+        A = Set(x for x in list(range(-5, 5)) if x != 0)
+        B = Set((10 // y for y in A if y < 2), chunk_size=2)
+        self.assertEqual(list(B), [10 // y for y in range(-5, 2) if y != 0])
+        self.assertEqual(list(A), [-5, -4, -3, -2, -1, 1, 2, 3, 4])
+
+
+class IncrementalSuite(unittest.TestCase):
+    def test_domain(self):
+        D = Domain([3, 1, 2], canonical=True)
+        version = D.version
+        D.add(5)
+        D.update([0, 1])
+        D.discard(2)
+        D.difference_update([7, 3])
+        self.assertEqual(list(D), [0, 1, 5])
+        self.assertEqual(D.version, version + 4)
+        self.assertIn(5, D)
+        self.assertNotIn(2, D)
+
+    def test_set(self):
+        D = Domain(list(range(10)))
+        A = Set(x*x for x in D if x % 2 == 0)
+        self.assertEqual(list(A), [0, 4, 16, 36, 64])
+        D.difference_update([2, 3])
+        D.update([12, 13])
+        self.assertEqual(list(A), [0, 16, 36, 64, 144])
+        D.discard(0)
+        self.assertEqual(list(A), [16, 36, 64, 144])
+
+    def test_operations(self):
+        D = Domain([1, 2, 3])
+        E = Domain([3, 4])
+        union, intersection, difference = D | E, D & E, D - E
+        for s in (union, intersection, difference):
+            list(s)
+        D.add(4)
+        E.discard(3)
+        self.assertEqual(union.elements.tolist(), [1, 2, 3, 4])
+        self.assertEqual(intersection.elements.tolist(), [4])
+        self.assertEqual(difference.elements.tolist(), [1, 2, 3])
+
+    def test_invalidation(self):
+        D = Domain([1, 2, 3])
+        A = Set(x for x in D if x > 1)
+        B = Set(y*10 for y in A)
+        self.assertEqual(list(B), [20, 30])
+        D.add(7)
+        self.assertIsNone(B.elements)
+        self.assertEqual(list(B), [20, 30, 70])
+
+
+class StatisticsSuite(unittest.TestCase):
+    def test_sketch(self):
+        sketch = HyperLogLog()
+        sketch.add(numpy.random.RandomState(0).randint(0, 2**40, 100000))
+        self.assertAlmostEqual(sketch.count(), 100000, delta=5000)
+        sketch.add(numpy.arange(10))
+        merged = sketch.merge(HyperLogLog())
+        self.assertEqual(merged.count(), sketch.count())
+
+    def test_statistics(self):
+        A = Set(x for x in numpy.arange(10**5) if x % 3 == 0)
+        statistics = A.statistics()
+        self.assertIsNone(A.elements)
+        self.assertEqual(statistics.count, 33334)
+        self.assertEqual((statistics.minimum, statistics.maximum), (0, 99999))
+        self.assertIs(A.statistics(), statistics)
+
+    def test_incremental(self):
+        D = Domain([1, 2, 3])
+        statistics = D.statistics()
+        D.update([4, 5])
+        self.assertIs(D.statistics(), statistics)
+        self.assertEqual(statistics.maximum, 5)
+        D.discard(1)
+        self.assertEqual(D.statistics().count, 4)
+
+    def test_estimates(self):
+        A = Domain(numpy.arange(0, 200000))
+        B = Domain(numpy.arange(150000, 400000))
+        C = Domain(numpy.arange(10**6, 10**6 + 100))
+        cases = [(A | B, 400000), (A & B, 50000), (A - B, 150000),
+                 (A ^ B, 350000), ((A | B) & C, 0)]
+        for s, size in cases:
+            self.assertAlmostEqual(estimate_size(s), size, delta=20000)
+            self.assertIsNone(s.elements)
+
+
+class BloomFilterSuite(unittest.TestCase):
+    def test_membership(self):
+        D = Domain(numpy.arange(0, 200000, 2))
+        bloom = D.bloom_filter(0.01)
+        mask = bloom.isin(numpy.arange(200000))
+        self.assertTrue(mask[::2].all())
+        self.assertLess(mask[1::2].mean(), 0.02)
+        self.assertLess(bloom.nbytes, D.elements.nbytes / 4)
+        self.assertIn(10, bloom)
+
+    def test_union(self):
+        a = BloomFilter(100)
+        b = BloomFilter(100)
+        a.add([1, 2])
+        b.add([3])
+        self.assertTrue((a | b).isin([1, 2, 3]).all())
+        with self.assertRaises(ValueError):
+            a | BloomFilter(1000)
+
+    def test_streamed(self):
+        A = Set(x for x in numpy.arange(1000) if x % 5 == 0)
+        bloom = A.bloom_filter()
+        self.assertIsNone(A.elements)
+        self.assertTrue(bloom.isin(numpy.arange(0, 1000, 5)).all())
+
+
+class SumSuite(unittest.TestCase):
+    def test_flatten(self):
+        A, B, C = Domain([3, 1]), Domain([2]), Domain([1, 5])
+        S = A + B + C
+        self.assertEqual(len(S.sets), 3)
+        self.assertEqual(list(S), [3, 1, 2, 1, 5])
+        self.assertEqual(len(S), 5)
+        self.assertIn(5, S)
+
+    def test_unique(self):
+        sets = [Domain(numpy.arange(i, 1000, 3)) for i in range(3)]
+        sets.append(Domain([999, 0, 2000]))
+        S = Sum(*sets, unique=True)
+        chunks = list(S.iter_chunks(100))
+        self.assertTrue(all(len(c) <= 400 for c in chunks))
+        self.assertEqual(numpy.concatenate(chunks).tolist(),
+                         list(range(1000)) + [2000])
+        self.assertEqual(list(S), list(range(1000)) + [2000])
+        self.assertEqual(len(S), 1001)
+
+
+class CompactSuite(unittest.TestCase):
+    def test_integers(self):
+        self.assertEqual(Domain([1, 2, 3]).elements.dtype, numpy.int8)
+        self.assertEqual(Domain([-1, 40000]).elements.dtype, numpy.int32)
+        A = Set(x for x in range(1000))
+        self.assertEqual(A.progression.to_array().dtype, numpy.int16)
+        self.assertEqual(Domain([1.5, 0.25]).elements.dtype, numpy.float32)
+        self.assertEqual(Domain([0.1]).elements.dtype, numpy.float64)
+
+    def test_no_overflow(self):
+        D = Domain([100, 120])
+        A = Set(x*x for x in D)
+        B = Set((x*x for x in D), vectorize=False)
+        self.assertEqual(list(A), [10000, 14400])
+        self.assertEqual(list(B), [10000, 14400])
+        self.assertEqual(A.elements.dtype, numpy.int16)
+
+    def test_promotion(self):
+        A, B = Domain([1, 200]), Domain([-3, 200, 40000])
+        self.assertEqual(list(A | B), [-3, 1, 200, 40000])
+        self.assertEqual(list(A & B), [200])
+        self.assertIn(200, B)
+        probe = numpy.array([200], dtype=numpy.int16)
+        self.assertEqual(B.isin(probe).tolist(), [True])
+        probe = numpy.array([1, 300, -200, 1.5, 200.0])
+        self.assertEqual(A.isin(probe).tolist(),
+                         [True, False, False, False, True])
+
+    def test_wide_iteration(self):
+        A = Domain(list(range(70000)))
+        self.assertEqual(A.elements.dtype, numpy.int32)
+        values = list(A)
+        self.assertEqual(values, list(range(70000)))
+        self.assertEqual(values[-1].dtype, numpy.int64)
+        B = Set(x*x for x in A if x < 3)
+        self.assertEqual(list(B), [0, 1, 4])
+
+    def test_explicit(self):
+        self.assertEqual(Domain([1, 2], dtype=float).elements.dtype,
+                         numpy.float64)
+        A = Set((x for x in list(range(3))), dtype=numpy.int64)
+        self.assertEqual(list(A), [0, 1, 2])
+        self.assertEqual(A.elements.dtype, numpy.int64)
+
+
+class SummarySuite(unittest.TestCase):
+    def test_fingerprint(self):
+        A = Domain([3, 1, 2, 3])
+        B = Domain([1.0, 2.0, 3.0])
+        self.assertEqual(A.fingerprint(), B.fingerprint())
+        self.assertNotEqual(A.fingerprint(), Domain([1, 2, 4]).fingerprint())
+        self.assertIs(A.fingerprint(), A.fingerprint())
+
+    def test_bools(self):
+        A, B = Domain([1, 2]), Domain([1, 2, 3])
+        for result in (A == B, A.issubset(B), A < B, A <= B, B > A, B >= A):
+            self.assertIsInstance(result, bool)
+        self.assertTrue(A < B)
+        self.assertFalse(B <= A)
+        self.assertFalse(A < Domain([2, 1]))
+        self.assertTrue(A <= Domain([2, 1]))
+        self.assertFalse(Domain([0, 2]) <= B)
+
+    def test_symbolic(self):
+        A = Set(x for x in Reals if 0 < x < 1)
+        B = Set(x for x in Reals if 0 < x < 2)
+        self.assertTrue(A <= B)
+        self.assertTrue(A < B)
+        self.assertTrue(B > A)
+        self.assertFalse(A >= B)
+        self.assertFalse(A < A)
+
+    def test_changes(self):
+        A, B = Domain([1, 2]), Domain([1, 2])
+        self.assertEqual(A, B)
+        B.add(3)
+        self.assertNotEqual(A, B)
+        self.assertTrue(A < B)
+
+
+class MemoizeSuite(unittest.TestCase):
+    def test_cache(self):
+        calls = []
+
+        def slow(x):
+            calls.append(x)
+            return x + 1
+        A = Set((slow(x) for x in list(range(10))), memoize=2)
+        self.assertEqual([A(1), A(2), A(1), A(3), A(2)], [2, 3, 2, 4, 3])
+        self.assertEqual(calls, [1, 2, 3, 2])
+        info = A.call_cache.info()
+        self.assertEqual((info.hits, info.misses, info.currsize), (1, 4, 2))
+        self.assertEqual(info.hit_rate, 0.2)
+        self.assertEqual(A(numpy.array([4, 5])).tolist(), [5, 6])
+        self.assertIsNone(Set(x for x in list(range(3))).call_cache)
+        self.assertEqual(Set((x for x in ()), memoize=True).call_cache.maxsize,
+                         1024)
+        for memoize in (0, -1, 2.5):
+            with self.assertRaises(ValueError):
+                Set((x for x in ()), memoize=memoize)
+
+    def test_constrained(self):
+        D = Domain(list(range(10)))
+        A = Set(x for x in D if x > 2)
+        B = Set((x*10 for x in A), memoize=16)
+        self.assertEqual(B(3), 30)
+        self.assertEqual(B(3), 30)
+        with self.assertRaises(ValueError):
+            B(1)
+        self.assertEqual(B.call_cache.info().hits, 1)
+        D.update([20])
+        self.assertEqual(B.call_cache.info().currsize, 0)
+        self.assertEqual(B(20), 200)
+
+    def test_threads(self):
+        import concurrent.futures
+        A = Set((x*x for x in list(range(100))), memoize=32)
+        with concurrent.futures.ThreadPoolExecutor(4) as executor:
+            results = list(executor.map(A, [i % 50 for i in range(1000)]))
+        self.assertEqual(results, [(i % 50)**2 for i in range(1000)])
+        info = A.call_cache.info()
+        self.assertEqual(info.hits + info.misses, 1000)
+        self.assertLessEqual(info.currsize, 32)
+
+
+class FrontEndSuite(unittest.TestCase):
+    def test_free_variables(self):
+        k = 3
+        A = Set(x + k for x in list(range(5)) if x > k - 2)
+        self.assertEqual(list(A), [5, 6, 7])
+        self.assertEqual(A(2), 5)
+
+    def test_same_line(self):
+        A, B = Set(x for x in [1, 2]), Set(2*x for x in [1, 2])
+        self.assertEqual((list(A), list(B)), ([1, 2], [2, 4]))
+
+    def test_nested_expression(self):
+        A = Set(sum(y for y in range(x)) for x in [1, 2, 3])
+        self.assertEqual(list(A), [0, 1, 3])
+        self.assertEqual(A(3), 3)
+
+    def test_shared_code(self):
+        members = [get_member(x*i for x in ()) for i in range(2)]
+        self.assertIs(members[0].__code__, members[1].__code__)
+
+    def test_folded_constants(self):
+        A = Set(x for x in range(10) if x >= 10/3 and x < 2**3)
+        self.assertEqual(list(A), [4, 5, 6, 7])
+        self.assertEqual(A.engine, "progression")
+
+    def test_without_source(self):
+        namespace = {"Set": Set}
+        exec("A = Set(x*2 for x in range(6) if x > 1 and x % 2 == 0)",
+             namespace)
+        A = namespace["A"]
+        self.assertEqual(list(A), [4, 8])
+        self.assertEqual(A(2), 4)
+        self.assertTrue(math.isnan(A(1)))
+        with self.assertRaises(ValueError):
+            get_member(eval("(x for x in [1, 2] if x > 1)"))(1)
+
+    def test_changed_source(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "numset_changed.py")
+            with open(path, "w") as f:
+                f.write("def generator():\n"
+                        "    return (x + 1 for x in [1, 2, 3])\n")
+            sys.path.insert(0, directory)
+            try:
+                module = importlib.import_module("numset_changed")
+            finally:
+                sys.path.remove(directory)
+                sys.modules.pop("numset_changed", None)
+            with open(path, "w") as f:
+                f.write("def generator():\n"
+                        "    return (x * 9 for x in [1, 2, 3])\n")
+            os.utime(path, (0, 0))
+            A = Set(module.generator())
+            self.assertEqual(list(A), [2, 3, 4])
+            self.assertEqual(A(1), 2)
+
+    def test_free_variable_engines(self):
+        k = 3
+        A = Set(x + k for x in numpy.arange(10) if x > k)
+        self.assertEqual(list(A), list(range(7, 13)))
+        self.assertEqual(A.engine, "vectorized")
+        B = Set(x*k for x in range(10) if x % k == 0)
+        self.assertEqual(list(B), [0, 9, 18, 27])
+        self.assertEqual(B.engine, "progression")
+        C = Set(x for x in Reals if x > k)
+        self.assertEqual(C.symbolic, sympy.Interval.open(3, sympy.oo))
+        D = Domain(range(10))
+        E = Set((x, y) for x, y in D.cartesian(D) if x == y + k)
+        self.assertEqual(len(list(E)), 7)
+        self.assertEqual(E.engine, "join")
+
+    def test_rebound_progression(self):
+        k = 1
+        A = Set(x + k for x in range(5))
+        k = 100
+        self.assertEqual(list(A), [100, 101, 102, 103, 104])
+        self.assertEqual(A(1), 101)
+        self.assertEqual(A.engine, "progression")
+
+    def test_rebound_variables(self):
+        k = 1
+        A = Set(x + k for x in [1, 2, 3])
+        k = 100
+        self.assertEqual(list(A), [101, 102, 103])
+        self.assertEqual(A(1), 101)
+
+    def test_unsupported(self):
+        with self.assertRaises(TypeError):
+            get_member(x for x in () for y in ())
+
+
+class ParallelSuite(unittest.TestCase):
+    def test_threads(self):
+        A = Set((x*x for x in list(range(1000)) if x % 3 == 0), workers=2,
+                chunk_size=100)
+        self.assertEqual(list(A), [x*x for x in range(1000) if x % 3 == 0])
+        self.assertEqual(A.engine, "parallel")
+
+    def test_processes(self):
+        A = Set((math.gcd(x, 12) for x in list(range(50)) if x % 2 == 0),
+                workers=2, chunk_size=7)
+        self.assertEqual(list(A), [math.gcd(x, 12) for x in range(0, 50, 2)])
+        B = Set((x + 1 for x in list(range(5))), workers=1,
+                executor="process")
+        self.assertEqual(list(B), [1, 2, 3, 4, 5])
+
+
+class ProfilerSuite(unittest.TestCase):
+    def test_disabled(self):
+        import numset
+        original = numset._sorted_isin
+        profiler = Profiler()
+        with profiler:
+            self.assertIsNot(numset._sorted_isin, original)
+        self.assertIs(numset._sorted_isin, original)
+        Domain([1, 2]) & Domain([2])
+        self.assertEqual(profiler.stats(), {})
+
+    def test_stats(self):
+        spans = []
+        profiler = Profiler()
+        profiler.enable(lambda *span: spans.append(span))
+        try:
+            A = Set(x for x in list(range(100)) if x % 2 == 0)
+            list(A & Domain([2, 3, 4]))
+        finally:
+            profiler.disable()
+        stats = profiler.stats()
+        label = "%s:%d" % (A.expression.gi_code.co_filename,
+                           A.expression.gi_code.co_firstlineno)
+        materialize = stats["Set._materialize", label]
+        self.assertEqual(materialize.calls, 1)
+        self.assertEqual(materialize.elements, 50)
+        self.assertGreaterEqual(materialize.bytes, A.elements.nbytes)
+        call = stats["_vectorized_call", label]
+        self.assertEqual(call.elements, 100)
+        self.assertIn(("_intersection_elements", ""), stats)
+        self.assertEqual(len(spans), sum(s.calls for s in stats.values()))
+        profiler.reset()
+        self.assertEqual(profiler.stats(), {})
+
+
+class VectorizedEngineSuite(unittest.TestCase):
+    def test_vectorized_path(self):
+        A = Set(x*2 for x in list(range(20)) if x % 3 == 0 and x > 2)
+        self.assertEqual(list(A), [6, 12, 18, 24, 30, 36])
+        self.assertEqual(A.engine, "vectorized")
+
+    def test_chained_comparison(self):
+        A = Set(x for x in list(range(10)) if 2 < x < 5)
+        self.assertEqual(list(A), [3, 4])
+        self.assertEqual(A.engine, "vectorized")
+
+    def test_ufunc_call(self):
+        A = Set(numpy.sqrt(x) for x in [1, 4, 9])
+        self.assertEqual(list(A), [1, 2, 3])
+        self.assertEqual(A.engine, "vectorized")
+
+    def test_many_variables(self):
+        A = Set((x, y) for x, y in [(0, 3), (1, 4), (2, 5)] if x != 1)
+        B = Set((x, y) for x, y in [(0, 3), (2, 5)])
+        self.assertEqual(A, B)
+        self.assertEqual(A.engine, "vectorized")
+
+    def test_nested_set(self):
+        A = Set(x for x in range(10) if x < 5)
+        B = Set(x + 10 for x in A)
+        self.assertEqual(list(B), [10, 11, 12, 13, 14])
+        self.assertEqual(B.engine, "vectorized")
+
+    def test_fallback_function_call(self):
+        A = Set(max(x, 3) for x in range(5))
+        self.assertEqual(list(A), [3, 3, 3, 3, 4])
+        self.assertEqual(A.engine, "python")
+
+    def test_fallback_generator_domain(self):
+        A = Set(x for x in (i for i in range(3)))
+        self.assertEqual(list(A), [0, 1, 2])
+        self.assertEqual(A.engine, "python")
+
+    def test_python_errors(self):
+        A = Set(x // 0 for x in range(3))
+        with self.assertRaises(ZeroDivisionError):
+            list(A)
+
+    def test_integer_overflow(self):
+        A = Set(2**x for x in range(62, 66))
+        self.assertEqual(list(A), [2**x for x in range(62, 66)])
+        self.assertEqual(A.engine, "python")
+
+    def test_disabled(self):
+        A = Set((x for x in range(3)), vectorize=False)
+        self.assertEqual(list(A), [0, 1, 2])
+        self.assertEqual(A.engine, "python")
+
+
 class DomainSuite(unittest.TestCase):
     def test_product(self):
         A = Domain([0, 1, 2])